@@ -0,0 +1,67 @@
+# [SublimeLinter @python:2]
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Importing kjr_parser should only define things; the server connections and the parse cache are
+# left for the first parse (see kjr_parser.Parser)
+BUDGET_MS = 100
+HEAVY_MODULES = ['nltk', 'simplejson']
+
+# Run in a fresh interpreter each time, so that nothing has been imported before
+MEASURE = '''
+import json, sys, time
+start = time.time()
+import kjr_parser
+elapsed = time.time() - start
+parser = kjr_parser.parser
+print(json.dumps({
+    'ms': elapsed * 1000,
+    'modules': [name for name in %r if name in sys.modules],
+    'created': [name for name in ['pool', 'server', 'async_server', 'cache']
+                if getattr(parser, name) is not None],
+}))
+'''
+
+
+def measure(heavy_modules):
+    '''Imports kjr_parser in a new interpreter and returns what that took and set up.'''
+    env = dict(os.environ)
+    env.pop('KJR_TRACE', None)
+    output = subprocess.check_output([sys.executable, '-c', MEASURE % heavy_modules],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Measures how long importing kjr_parser takes, and fails if it is over budget '
+                    'or loads anything heavy before it is used.')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=10,
+                            help='Number of imports to time (default: 10)')
+    arg_parser.add_argument('--budget', type=float, default=BUDGET_MS,
+                            help='Import time budget in ms, checked against the median '
+                                 '(default: {})'.format(BUDGET_MS))
+    args = arg_parser.parse_args()
+    runs = [measure(HEAVY_MODULES) for _ in range(args.repeat)]
+    times = sorted(run['ms'] for run in runs)
+    median = times[len(times) // 2]
+    print('import kjr_parser: min {:.1f} ms, median {:.1f} ms, max {:.1f} ms (budget {:.0f} ms)'
+          .format(times[0], median, times[-1], args.budget))
+    failures = []
+    if median > args.budget:
+        failures.append('the median import time is over budget')
+    modules = sorted(set(name for run in runs for name in run['modules']))
+    if modules:
+        failures.append('importing it loads {}'.format(', '.join(modules)))
+    created = sorted(set(name for run in runs for name in run['created']))
+    if created:
+        failures.append('importing it creates the {}'.format(', '.join(created)))
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    sys.exit(1 if failures else 0)
@@ -2,24 +2,173 @@
 
 from __future__ import print_function
 
-import pprint
 from enum import Enum
-from stanford_corenlp_python import jsonrpc
-from simplejson import loads
+from stanford_corenlp_python import jsonrpc, compact, tracing
 import dependency as dp
-from nltk.stem.snowball import SnowballStemmer
 from collections import namedtuple
-from log import warning
+from log import warning, Trace, NULL_TRACE, LEVELS, FORMATS, ACTIONS, GROUPINGS, DETAILS
+from parse_cache import ParseCache, FixtureStore
+import atexit
+import os
+import re
 import sys
+import threading
 
 
 Line = namedtuple('Line', ['line', 'indent'])
 
 
 def get_corenlp_result(sentence):
-    result = loads(server.parse(sentence))
-    # pp = pprint.PrettyPrinter()
-    # pp.pprint(result)
+    return get_corenlp_results([sentence])[0]
+
+
+def get_corenlp_results(sentences):
+    '''
+    Returns the CoreNLP result of each of sentences. Results that are not recorded or cached are
+    parsed in a single JSON-RPC batch, i.e. one round trip to the server for all of them.
+    '''
+    results = [lookup_result(sentence) for sentence in sentences]
+    missing = [i for i, result in enumerate(results) if result is None]
+    for i, result in zip(missing, request_results([sentences[i] for i in missing])):
+        results[i] = store_result(sentences[i], result)
+    return results
+
+
+def request_results(texts):
+    '''Parses texts with the server in a single JSON-RPC batch, without looking in the cache.'''
+    results = request_each(texts)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+def request_each(texts):
+    '''
+    Like request_results, but returns the exception a text failed with in place of its result,
+    instead of raising the first one.
+    '''
+    if not texts:
+        return []
+    with parser.get_server()._batch() as batch:
+        calls = [batch.annotate(text=text, deadline=DEADLINE, compact=True, **PARSE_OPTIONS)
+                 for text in texts]
+    results = []
+    for call in calls:
+        try:
+            results.append(compact.decode(call.result()))
+        except jsonrpc.RPCError as e:
+            results.append(e)
+    return results
+
+
+def get_corenlp_results_packed(texts):
+    '''
+    Like get_corenlp_results, but packs the texts that have to be parsed into as few CoreNLP requests
+    as possible: up to PACK_CHARS characters of texts per request, separated by a boundary sentence,
+    at which the result is split again. The requests are sent concurrently. If CoreNLP did not keep
+    the texts of a request apart, or the request failed, they are parsed one by one instead. Instead
+    of raising, returns the exception a text failed with in place of its result, so that a failure
+    only affects the texts it is about.
+    '''
+    results = []
+    for text in texts:
+        try:
+            results.append(lookup_result(text))
+        except LookupError as e:
+            results.append(e)
+    groups = []
+    size = PACK_CHARS
+    for i, result in enumerate(results):
+        if result is None:
+            if size + len(texts[i]) > PACK_CHARS:
+                groups.append([])
+                size = 0
+            groups[-1].append(i)
+            size += len(texts[i]) + len(BOUNDARY)
+    futures = [parser.get_async_server().annotate(text=BOUNDARY.join(texts[i] for i in group),
+                                                  deadline=DEADLINE, compact=True, **PARSE_OPTIONS)
+               for group in groups]
+    for group, future in zip(groups, futures):
+        try:
+            unpacked = split_packed_result(compact.decode(future.result()), len(group))
+        except jsonrpc.RPCError:
+            unpacked = None
+        if unpacked is None:
+            unpacked = request_each([texts[i] for i in group])
+        for i, result in zip(group, unpacked):
+            results[i] = result if isinstance(result, Exception) else store_result(texts[i], result)
+    return results
+
+
+def split_packed_result(result, count):
+    '''
+    Splits the result of texts joined with BOUNDARY into the results of the texts. Returns None if the
+    result is an error or does not split into count texts.
+    '''
+    if 'error' in result:
+        return None
+    split = [[]]
+    for sentence in result['sentences']:
+        if [word[0] for word in sentence['words']] == BOUNDARY_WORDS:
+            split.append([])
+        else:
+            split[-1].append(sentence)
+    if len(split) != count:
+        return None
+    return [{'sentences': sentences} for sentences in split]
+
+
+def get_corenlp_result_async(sentence):
+    '''
+    Returns a jsonrpc.Future of get_corenlp_result(sentence) at once, without waiting for the server.
+    Up to CONNECTIONS requests are sent at a time; the others wait in line.
+    '''
+    future = jsonrpc.Future('annotate')
+    try:
+        result = lookup_result(sentence)
+    except LookupError as e:
+        future.set_exception(e)
+        return future
+    if result is not None:
+        future.set_result(result)
+        return future
+
+    def done(call):
+        try:
+            future.set_result(store_result(sentence, compact.decode(call.result())))
+        except Exception as e:
+            future.set_exception(e)
+    parser.get_async_server().annotate(text=sentence, deadline=DEADLINE, compact=True,
+                                       **PARSE_OPTIONS).add_done_callback(done)
+    return future
+
+
+def lookup_result(sentence):
+    '''Returns the recorded or cached result for sentence, or None if it has to be parsed.'''
+    fixtures = parser.fixtures
+    if parser.backend != 'server':
+        result = fixtures.get(sentence)
+        if result is not None:
+            return result
+        if parser.backend == 'replay':
+            raise LookupError('No recorded CoreNLP result in {} for: {}'.format(fixtures.path,
+                                                                                sentence))
+    cache = parser.get_cache()
+    result = cache.get(sentence) if cache is not None else None
+    if result is not None and parser.backend == 'record':
+        fixtures.put(sentence, result)
+    return result
+
+
+def store_result(sentence, result):
+    '''Caches (and in record mode, records) a result from the server, unless it is an error.'''
+    if 'error' not in result:
+        cache = parser.get_cache()
+        if cache is not None:
+            cache.put(sentence, result)
+        if parser.backend == 'record':
+            parser.fixtures.put(sentence, result)
     return result
 
 
@@ -43,6 +192,18 @@ class CondType(Enum):
     facing = 2
 
 
+class WordType(Enum):
+    verb = 1
+    condVerb = 2
+    number = 3
+    direction = 4
+    beeper = 5
+
+
+# An entry of the lexicon: the type of a word and the form the mappings know it by
+Lexeme = namedtuple('Lexeme', ['type', 'word'])
+
+
 class ActionGrouping:
     def __init__(self, verb):
         self.verb = verb
@@ -239,10 +400,199 @@ class AndCond:
         return lines
 
 # Initialization
-# Set up server connection
-server = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(),
-                             jsonrpc.TransportTcpIp(addr=("127.0.0.1", 8080)))
-stemmer = SnowballStemmer('english')
+# Settings are read from environment variables. A bad value is warned about and replaced by the
+# default, so that it cannot break importing the parser.
+def env_choice(name, choices, default):
+    '''
+    Returns the value of the environment variable name, or default if it is not set or not one of
+    choices.
+    '''
+    value = os.environ.get(name, default)
+    if value not in choices:
+        warning('Ignoring {}={!r}, expected one of {}; using {!r}'.format(
+            name, value, ', '.join(choices), default))
+        return default
+    return value
+
+
+def env_int(name, default, minimum=1):
+    '''Like env_choice, for environment variables holding an integer of at least minimum.'''
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        warning('Ignoring {}={!r}, expected an integer of at least {}; using {}'.format(
+            name, value, minimum, default))
+        return default
+    return number
+
+
+# Server connections, made on first use and kept open between requests. Every thread parsing at the
+# same time gets a connection of its own, up to KJR_CONNECTIONS of them. Set KJR_SERVER to connect to
+# another host:port. The server is told how long we wait for each response (DEADLINE seconds), and
+# gives up on a request by then, answering with an error instead; the socket waits a little longer,
+# so that the error arrives before the socket times out.
+SERVER_ADDR = os.environ.get('KJR_SERVER', '127.0.0.1:8080')
+CONNECTIONS = env_int('KJR_CONNECTIONS', 4)
+DEADLINE = 40
+DEADLINE_SLACK = 2
+# Responses larger than KJR_MAX_MESSAGE MB are refused with a jsonrpc.RPCTransportError saying so
+MAX_MESSAGE = env_int('KJR_MAX_MESSAGE', 16) * 1024 * 1024
+
+# Set KJR_TRACE to a file name to record how long each phase of each CoreNLP request takes (see
+# stanford_corenlp_python/tracing.py); the spans are written to it on exit, in the Chrome trace
+# format. Start the server with --trace to record its side of the requests, too.
+TRACE_PATH = os.environ.get('KJR_TRACE')
+if TRACE_PATH:
+    atexit.register(tracing.enable().dump, TRACE_PATH)
+
+# parse_many packs up to PACK_CHARS characters of documents into a CoreNLP request, separated by a
+# sentence of its own that does not occur in documents. It is the length of the lines the server
+# feeds CoreNLP (MAX_LINE in stanford_corenlp_python/corenlp.py), so that a pack is parsed well
+# within DEADLINE, and a request that fails takes few documents with it.
+PACK_CHARS = 4000
+BOUNDARY_WORDS = ['Kjrboundary', '.']
+BOUNDARY = ' {} '.format(' '.join(BOUNDARY_WORDS))
+
+# Only the words and dependencies are used, so don't have the server send the parse tree or
+# coreference sets
+PARSE_OPTIONS = {'parsetree': False, 'coref': False}
+
+# The server profile (see stanford_corenlp_python/corenlp.py) the server runs with. Set KJR_PROFILE
+# if it was not started with --profile karel.
+PROFILE = os.environ.get('KJR_PROFILE', 'karel')
+
+
+def read_annotators(profile):
+    '''Returns the annotators the server loads with profile, as listed in its properties file.'''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stanford_corenlp_python',
+                        '{}.properties'.format(profile))
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() == 'annotators':
+                    return [annotator.strip() for annotator in value.split(',')]
+    except IOError:
+        warning('No properties file for KJR_PROFILE={!r} at {}'.format(profile, path))
+    return []
+
+
+# CoreNLP results are cached on disk, keyed by the sentence and the configuration it was parsed
+# with: the profile, its annotators and PARSE_OPTIONS. Set KJR_CACHE to another database file to
+# move the cache, or to an empty string to disable it.
+CACHE_CONFIG = 'corenlp-3.4.1 {} {} {}'.format(PROFILE, ','.join(read_annotators(PROFILE)),
+                                               sorted(PARSE_OPTIONS.items()))
+CACHE_PATH = os.environ.get('KJR_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'corenlp_cache.sqlite'))
+
+# Where CoreNLP results come from (see Parser.use_backend). Set KJR_BACKEND to 'record' or 'replay'
+# to record results to, or replay them from, the fixtures in KJR_FIXTURES (tests/fixtures by
+# default).
+BACKENDS = ('server', 'record', 'replay')
+FIXTURES_PATH = os.environ.get('KJR_FIXTURES', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures'))
+
+# How much of each parse is written to the log file passed to parse_sentences (see log.Trace), from
+# 'off' to 'details', and whether as text or as JSON lines. Set KJR_LOG_LEVEL and KJR_LOG_FORMAT to
+# change them.
+LOG_LEVEL = LEVELS.index(env_choice('KJR_LOG_LEVEL', LEVELS, 'details'))
+LOG_FORMAT = env_choice('KJR_LOG_FORMAT', FORMATS, 'text')
+
+
+def get_trace(log_file):
+    '''
+    Returns the Trace to write the steps of a parse to log_file with, at LOG_LEVEL in LOG_FORMAT.
+    log_file may also be a Trace already, or None to trace nothing.
+    '''
+    if isinstance(log_file, Trace):
+        return log_file
+    if log_file is None:
+        return NULL_TRACE
+    return Trace(log_file, LOG_LEVEL, LOG_FORMAT)
+
+
+class Parser:
+    '''
+    The resources parsing needs: the connections to the CoreNLP server, the parse cache and the
+    recorded fixtures. Each is created the first time it is used, so that importing kjr_parser
+    neither connects to the server nor opens the cache database.
+    '''
+    def __init__(self, server_addr=SERVER_ADDR, connections=CONNECTIONS, max_message=MAX_MESSAGE,
+                 cache_path=CACHE_PATH, backend='server', fixtures_path=FIXTURES_PATH):
+        self.server_addr = server_addr
+        self.connections = connections
+        self.max_message = max_message
+        self.cache_path = cache_path
+        self.pool = None
+        self.server = None
+        self.async_server = None
+        self.cache = None
+        self.lock = threading.Lock()
+        self.backend = None
+        self.fixtures = None
+        self.use_backend(backend, fixtures_path)
+
+    def use_backend(self, name, fixtures_path=None):
+        '''
+        Selects where CoreNLP results come from: 'server' asks the CoreNLP server, 'record' asks it
+        and saves the results as fixtures, 'replay' only uses the saved fixtures, without a server.
+        '''
+        if name not in BACKENDS:
+            raise ValueError('Unknown backend {!r}, expected one of {}'.format(name, BACKENDS))
+        self.backend = name
+        if fixtures_path is not None:
+            self.fixtures = FixtureStore(fixtures_path, CACHE_CONFIG)
+
+    def connect(self):
+        host, port = self.server_addr.rsplit(':', 1)
+        return jsonrpc.TransportTcpIp(addr=(host, int(port)), timeout=DEADLINE + DEADLINE_SLACK,
+                                      keepalive=True, max_message=self.max_message)
+
+    def get_pool(self):
+        '''
+        Returns the pool of server connections, which the synchronous and the asynchronous calls
+        share, so that there are never more than self.connections of them.
+        '''
+        with self.lock:
+            if self.pool is None:
+                self.pool = jsonrpc.TransportPool(self.connect, max_size=self.connections)
+            return self.pool
+
+    def get_server(self):
+        pool = self.get_pool()
+        with self.lock:
+            if self.server is None:
+                self.server = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), pool)
+            return self.server
+
+    def get_async_server(self):
+        pool = self.get_pool()
+        with self.lock:
+            if self.async_server is None:
+                self.async_server = jsonrpc.AsyncServerProxy(jsonrpc.JsonRpc20(), pool,
+                                                             max_in_flight=self.connections,
+                                                             timeout=DEADLINE + DEADLINE_SLACK)
+                # Stop its threads before the interpreter tears down what they use
+                atexit.register(self.async_server._close)
+            return self.async_server
+
+    def get_cache(self):
+        '''Returns the ParseCache, or None if the cache is disabled.'''
+        if not self.cache_path:
+            return None
+        with self.lock:
+            if self.cache is None:
+                self.cache = ParseCache(self.cache_path, CACHE_CONFIG)
+                atexit.register(self.cache.flush)
+            return self.cache
+
+
+parser = Parser(backend=env_choice('KJR_BACKEND', BACKENDS, 'server'))
 
 verb_mapping = {
     'move': ActionType.move,
@@ -283,97 +633,56 @@ relative_dir_mapping = {
 
 cardinal_dirs = ['north', 'south', 'east', 'west', 'up', 'down']
 
-
-def parse_sentence(sentence, dependencies, words, log_file=None):
-    pp = pprint.PrettyPrinter(stream=log_file)
-    # corenlp_result = get_corenlp_result(sentence)
-    # pp.pprint(corenlp_result)
-    # dependencies = get_dependencies(corenlp_result)
-    # words = get_words(corenlp_result)
-    sorted_deps = sorted(dependencies, key=lambda x: x.index)
-    pp.pprint(sorted_deps)
-    print(file=log_file)
-    root_dep = dp.find_first_dep_with_tag(sorted_deps, 'root')
-
-    # First do a naive search, looking for any keyword that we are interested in
-    verbs = []
-    cond_verbs = []
-    nums = []
-    directions = []
-    for index, word in enumerate(words):
-        if word in verb_mapping:
-            verbs.append(dp.dep_at_index(sorted_deps, index + 1))
-        elif word in number_mapping:
-            nums.append(dp.dep_at_index(sorted_deps, index + 1))
-        elif word in relative_dir_mapping or word in cardinal_dirs:
-            directions.append(dp.dep_at_index(sorted_deps, index + 1))
-        elif word in cond_verb_mapping:
-            cond_verbs.append(dp.dep_at_index(sorted_deps, index + 1))
-
-    dobj = dp.find_descendants_with_tag(sorted_deps, root_dep.index, 'dobj')
-    marks = dp.find_descendants_with_tag(sorted_deps, root_dep.index, 'mark')
-
-    for mark in marks:
-        closest_anc = dp.find_closest_ancestor_from(sorted_deps, mark.index, verbs)
-        print('{}: {}'.format(mark, closest_anc), file=log_file)
-
-    print('verbs: {}'.format(verbs), file=log_file)
-    print('cond_verbs: {}'.format(cond_verbs), file=log_file)
-    print('dobj: {}'.format(dobj), file=log_file)
-    print('nums: {}'.format(nums), file=log_file)
-    print('directions: {}'.format(directions), file=log_file)
-
-    print(file=log_file)
-    print('=== NUMS ===', file=log_file)
-    for dep in nums:
-        print('{}: {}'.format(dep, dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs)), file=log_file)
-    print(file=log_file)
-    print('=== DIRECTIONS ===', file=log_file)
-    for dep in directions:
-        print('{}: {}'.format(dep, dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs)), file=log_file)
-    print(file=log_file)
-
-    action_groupings = []
-    for verb in verbs:
-        grouping = ActionGrouping(verb)
-        for dep in nums:
-            if dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs) == verb:
-                grouping.numbers.append(dep)
-        for dep in directions:
-            if dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs) == verb:
-                grouping.directions.append(dep)
-        for dep in dobj:
-            if dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs) == verb:
-                grouping.object = dep
-        action_groupings.append(grouping)
-
-    cond_groupings = []
-    for verb in cond_verbs:
-        grouping = CondGrouping(verb)
-        grouping.parent = dp.find_closest_ancestor_from(sorted_deps, verb.index, verbs)
-        if grouping.condType == CondType.facing:
-            for dep in directions:
-                ancestor = dp.find_closest_ancestor_from(sorted_deps, dep.index, cond_verbs)
-                if ancestor is not None and ancestor == verb:
-                    grouping.direction = dep
-                    break
-            if grouping.direction is None:
-                warning('CondGrouping with type dir does not have a direction')
-        cond_groupings.append(grouping)
-
-    print('=== ACTION GROUPINGS ===', file=log_file)
-    pp.pprint(action_groupings)
-    print(file=log_file)
-
-    print('=== COND GROUPINGS ===', file=log_file)
-    pp.pprint(cond_groupings)
-    print(file=log_file)
-
-    # Build actions
+beeper_nouns = ['beeper', 'beepers']
+
+
+def build_lexicon():
+    '''
+    Indexes every word the parser looks for (the keys of the mappings above), so that a single
+    lookup tells whether a token is one of them, which one, and of what type.
+    '''
+    lexicon = {}
+    for words, word_type in [(verb_mapping, WordType.verb), (cond_verb_mapping, WordType.condVerb),
+                             (number_mapping, WordType.number),
+                             (relative_dir_mapping, WordType.direction),
+                             (cardinal_dirs, WordType.direction)]:
+        for word in words:
+            lexicon[word] = Lexeme(word_type, word)
+    for word in beeper_nouns:
+        lexicon[word] = Lexeme(WordType.beeper, 'beeper')
+    return lexicon
+
+lexicon = build_lexicon()
+
+# The part-of-speech tags (by prefix) a token must have to be looked up by its lemma, for each type
+# of word that has inflected forms: "moves" is the verb "move" as VBZ, but not as the noun NNS
+LEMMA_TAGS = {WordType.verb: 'VB', WordType.condVerb: 'VB', WordType.beeper: 'NN'}
+
+
+def lookup_word(word, lemma=None, tag=None):
+    '''
+    Returns the Lexeme of a token, or None if the parser does not look for it. The token is looked
+    up by its surface form first, so that "has" and "facing" are conditions rather than forms of
+    "have" and "face", and then by its CoreNLP lemma, so that "moves" and "turned" are verbs. The
+    lemma is only used if the token's tag is of the lexeme's word class (see LEMMA_TAGS).
+    '''
+    lexeme = lexicon.get(word)
+    if lexeme is None and lemma is not None and tag is not None:
+        lexeme = lexicon.get(lemma)
+        if lexeme is None or lexeme.type not in LEMMA_TAGS:
+            return None
+        if not tag.startswith(LEMMA_TAGS[lexeme.type]):
+            return None
+    return lexeme
+
+
+def build_actions(action_groupings, log_file=None):
+    '''Builds the actions for the verbs of a sentence, grouped with their numbers and directions.'''
+    trace = get_trace(log_file)
     actions = []
     for group in action_groupings:
         # if verb_mapping[group.verb.word] == ActionType.move and (group.object is None or
-        #    stemmer.stem(group.object.word) == 'space' or group.object.word == 'himself' or
+        #    group.object.word == 'space' or group.object.word == 'himself' or
         #    group.object.word == 'itself'):
         if verb_mapping[group.verb.word] == ActionType.move:
             # We'll assume for now that the word 'move' always translates to a move action. This
@@ -386,21 +695,21 @@ def parse_sentence(sentence, dependencies, words, log_file=None):
                     if direction.word in relative_dir_mapping:
                         action = TurnAction(relative_dir_mapping[direction.word], None)
                         actions.append(action)
-                        print(action, file=log_file)
+                        trace.event(DETAILS, 'action', action=action)
                     elif direction.word in cardinal_dirs:
                         action = TurnAction(None, direction.word)
                         actions.append(action)
-                        print(action, file=log_file)
+                        trace.event(DETAILS, 'action', action=action)
                     action = MoveAction('karel', 1)
                     actions.append(action)
-                    print(action, file=log_file)
+                    trace.event(DETAILS, 'action', action=action)
             elif len(group.directions) == 0:
                 # No directions, so we move forward the specified number of times in the forward
                 # direction
                 for num in group.numbers:
                     action = MoveAction('karel', number_mapping[num.word])
                     actions.append(action)
-                    print(action, file=log_file)
+                    trace.event(DETAILS, 'action', action=action)
             else:
                 move_action = MoveAction('karel', number_mapping[group.numbers[0].word])
                 if len(group.directions) == 0:
@@ -414,9 +723,9 @@ def parse_sentence(sentence, dependencies, words, log_file=None):
                         turn_action = None
                 if turn_action is not None:
                     actions.append(turn_action)
-                    print(turn_action, file=log_file)
+                    trace.event(DETAILS, 'action', action=turn_action)
                 actions.append(move_action)
-                print(move_action, file=log_file)
+                trace.event(DETAILS, 'action', action=move_action)
         elif verb_mapping[group.verb.word] == ActionType.turn:
             if len(group.directions) == 0:
                 warning('No direction specified for TurnAction')
@@ -433,39 +742,119 @@ def parse_sentence(sentence, dependencies, words, log_file=None):
                     turn_action = TurnAction(None, group.directions[0].word)
             if turn_action is not None:
                 actions.append(turn_action)
-                print(turn_action, file=log_file)
+                trace.event(DETAILS, 'action', action=turn_action)
         elif verb_mapping[group.verb.word] == ActionType.pickBeeper:
             # Assume that we're picking up a beeper
-            if group.object is not None and stemmer.stem(group.object.word) != 'beeper':
+            if group.object is not None and group.object.word != 'beeper':
                 warning('Direct object of the pick action verb was not "beeper"')
             if len(group.directions) != 0:
                 warning('Directions in pick action grouping')
             if len(group.numbers) == 0:
                 # If no numbers present, assume that we pick up one beeper
                 pick_action = PickAction(1)
-                print(pick_action, file=log_file)
+                trace.event(DETAILS, 'action', action=pick_action)
                 actions.append(pick_action)
             else:
                 for num in group.numbers:
                     pick_action = PickAction(number_mapping[num.word])
-                    print(pick_action, file=log_file)
+                    trace.event(DETAILS, 'action', action=pick_action)
                     actions.append(pick_action)
         elif verb_mapping[group.verb.word] == ActionType.putBeeper:
-            if group.object is not None and stemmer.stem(group.object.word) != 'beeper':
+            if group.object is not None and group.object.word != 'beeper':
                 warning('Direct object of the put action verb was not "beeper"')
             if len(group.directions) != 0:
                 warning('Directions in pick action grouping')
             if len(group.numbers) == 0:
                 # If no numbers present, assume that we put one beeper
                 put_action = PutAction(1)
-                print(put_action, file=log_file)
+                trace.event(DETAILS, 'action', action=put_action)
                 actions.append(put_action)
             else:
                 for num in group.numbers:
                     pick_action = PutAction(number_mapping[num.word])
-                    print(pick_action, file=log_file)
+                    trace.event(DETAILS, 'action', action=pick_action)
                     actions.append(pick_action)
-    print(actions, file=log_file)
+    return actions
+
+
+def parse_sentence(sentence, dependencies, words, log_file=None, lemmas=None, tags=None):
+    trace = get_trace(log_file)
+    # corenlp_result = get_corenlp_result(sentence)
+    # dependencies = get_dependencies(corenlp_result)
+    # words = get_words(corenlp_result)
+    trace.event(ACTIONS, 'sentence', words=words)
+    sorted_deps = sorted(dependencies, key=lambda x: x.index)
+    trace.event(DETAILS, 'dependencies', dependencies=sorted_deps)
+    root_dep = dp.find_first_dep_with_tag(sorted_deps, 'root')
+
+    # First do a naive search, looking for any keyword that we are interested in
+    verbs = []
+    cond_verbs = []
+    nums = []
+    directions = []
+    found = {WordType.verb: verbs, WordType.condVerb: cond_verbs, WordType.number: nums,
+             WordType.direction: directions}
+    for index, word in enumerate(words):
+        lexeme = lookup_word(word, lemmas[index] if lemmas is not None else None,
+                             tags[index] if tags is not None else None)
+        if lexeme is None:
+            continue
+        dep = dp.dep_at_index(sorted_deps, index + 1)
+        if dep is not None:
+            # The mappings know the word by its lexicon form ("move" for "moves")
+            dep.word = lexeme.word
+        if lexeme.type in found:
+            found[lexeme.type].append(dep)
+
+    dobj = dp.find_descendants_with_tag(sorted_deps, root_dep.index, 'dobj')
+    marks = dp.find_descendants_with_tag(sorted_deps, root_dep.index, 'mark')
+
+    if trace.enabled(DETAILS):
+        for mark in marks:
+            trace.event(DETAILS, 'mark', mark=mark,
+                        verb=dp.find_closest_ancestor_from(sorted_deps, mark.index, verbs))
+        trace.event(DETAILS, 'keywords', verbs=verbs, cond_verbs=cond_verbs, dobj=dobj, nums=nums,
+                    directions=directions)
+        for dep in nums:
+            trace.event(DETAILS, 'number', number=dep, verb=dp.find_closest_ancestor_from(
+                sorted_deps, dep.index, verbs + cond_verbs))
+        for dep in directions:
+            trace.event(DETAILS, 'direction', direction=dep, verb=dp.find_closest_ancestor_from(
+                sorted_deps, dep.index, verbs + cond_verbs))
+
+    action_groupings = []
+    for verb in verbs:
+        grouping = ActionGrouping(verb)
+        for dep in nums:
+            if dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs) == verb:
+                grouping.numbers.append(dep)
+        for dep in directions:
+            if dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs) == verb:
+                grouping.directions.append(dep)
+        for dep in dobj:
+            if dp.find_closest_ancestor_from(sorted_deps, dep.index, verbs + cond_verbs) == verb:
+                grouping.object = dep
+        action_groupings.append(grouping)
+
+    cond_groupings = []
+    for verb in cond_verbs:
+        grouping = CondGrouping(verb)
+        grouping.parent = dp.find_closest_ancestor_from(sorted_deps, verb.index, verbs)
+        if grouping.condType == CondType.facing:
+            for dep in directions:
+                ancestor = dp.find_closest_ancestor_from(sorted_deps, dep.index, cond_verbs)
+                if ancestor is not None and ancestor == verb:
+                    grouping.direction = dep
+                    break
+            if grouping.direction is None:
+                warning('CondGrouping with type dir does not have a direction')
+        cond_groupings.append(grouping)
+
+    trace.event(GROUPINGS, 'action_groupings', groupings=action_groupings)
+    trace.event(GROUPINGS, 'cond_groupings', groupings=cond_groupings)
+
+    actions = build_actions(action_groupings, trace)
+    trace.event(ACTIONS, 'actions', actions=actions)
 
     # Build conditionals
     if len(cond_groupings) == 0:
@@ -497,24 +886,270 @@ def parse_sentence(sentence, dependencies, words, log_file=None):
         else:
             cond = AndCond(cond_dirs, cond_hasBeeper, actions)
 
-    print(cond, file=log_file)
+    trace.event(ACTIONS, 'cond', cond=cond)
     if cond is not None:
         return [cond]
     else:
         return actions
 
 
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.!?])\s+')
+TOKEN_PATTERN = re.compile(r'[a-z]+|\S')
+
+
+class FastPath:
+    '''
+    Turns simple commands ("Karel should move two spaces north.", "Turn left.", "Pick up a
+    beeper.") into actions without parsing them with CoreNLP. A sentence is simple if it has a
+    single action verb, no condition, and otherwise only numbers, directions and the filler words
+    below; all of its numbers and directions then belong to the verb, which is what the dependency
+    parse would tell us, so the actions are built exactly as parse_sentence builds them.
+    '''
+    FILLERS = {'karel', 'he', 'she', 'it', 'should', 'will', 'must', 'can', 'then', 'next', 'now',
+               'first', 'finally', 'to', 'time', 'times', '.', '!'}
+    # Nouns that only make sense as the object of some verbs
+    MOVE_NOUNS = {'space', 'spaces', 'step', 'steps'}
+    BEEPER_NOUNS = set(beeper_nouns)
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # The counters are updated from the threads of parse_sentences_async, too
+        self.lock = threading.Lock()
+
+    def count(self, hits=0, misses=0):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def match(self, sentence):
+        '''Returns the ActionGrouping of a simple sentence, or None if it needs a full parse.'''
+        tokens = TOKEN_PATTERN.findall(sentence.lower())
+        if not tokens or '.' in tokens[:-1] or '!' in tokens[:-1]:
+            return None
+        grouping = None
+        for index, word in enumerate(tokens):
+            lexeme = lexicon.get(word)
+            word_type = lexeme.type if lexeme is not None else None
+            # Dependencies on the verb, with the same (1-based) indices as in a CoreNLP parse
+            dep = dp.Dependency(('dep', ('', 0),
+                                 (lexeme.word if lexeme is not None else word, index + 1)))
+            if word_type == WordType.verb:
+                if grouping is not None:
+                    return None
+                grouping = ActionGrouping(dep)
+                nums, directions, nouns = grouping.numbers, grouping.directions, []
+            elif grouping is None and word not in self.FILLERS:
+                # Only fillers may come before the verb
+                return None
+            elif word_type == WordType.number:
+                nums.append(dep)
+            elif word_type == WordType.direction:
+                directions.append(dep)
+            elif word in self.MOVE_NOUNS or word_type == WordType.beeper:
+                nouns.append(word)
+                grouping.object = dep
+            elif word not in self.FILLERS:
+                return None
+        if grouping is None:
+            return None
+        action_type = verb_mapping[grouping.verb.word]
+        if action_type == ActionType.move:
+            allowed_nouns = self.MOVE_NOUNS
+        elif action_type in (ActionType.pickBeeper, ActionType.putBeeper):
+            allowed_nouns = self.BEEPER_NOUNS
+        else:
+            allowed_nouns = ()
+        if any(noun not in allowed_nouns for noun in nouns):
+            return None
+        if action_type == ActionType.move:
+            grouping.object = None
+        return grouping
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / float(total) if total else 0.0}
+
+
+# Set KJR_FAST_PATH=0 to parse every sentence with CoreNLP
+fast_path = FastPath() if os.environ.get('KJR_FAST_PATH', '1') != '0' else None
+
+
+def split_sentences(text):
+    return [sentence for sentence in SENTENCE_END_PATTERN.split(text.strip()) if sentence]
+
+
+def parse_corenlp_sentence(sentences, corenlp_sentence, log_file=None):
+    with tracing.span('kjr.parse_sentence'):
+        dep_list = dp.convert_to_deps(corenlp_sentence['dependencies'])
+        word_list = [word[0].lower() for word in corenlp_sentence['words']]
+        lemma_list = [word[1].get('Lemma', word[0]).lower() for word in corenlp_sentence['words']]
+        tag_list = [word[1].get('PartOfSpeech') for word in corenlp_sentence['words']]
+        return parse_sentence(sentences, dep_list, word_list, log_file=log_file, lemmas=lemma_list,
+                              tags=tag_list)
+
+
+def match_fast_path(sentences):
+    '''
+    Splits sentences and matches each against the fast path. Returns the sentences, their
+    ActionGroupings (None where the fast path does not apply) and the sentences left for CoreNLP.
+    '''
+    parts = split_sentences(sentences)
+    groupings = [fast_path.match(part) for part in parts]
+    pending = [part for part, grouping in zip(parts, groupings) if grouping is None]
+    return parts, groupings, pending
+
+
+def iter_mixed_actions(parts, groupings, corenlp_sentences, log_file=None):
+    '''
+    Yields the actions of each of parts, built from its grouping if the fast path matched it, or
+    else from the next of corenlp_sentences, which are the results of the others, in order.
+    '''
+    trace = get_trace(log_file)
+    pending = len(corenlp_sentences)
+    fast_path.count(hits=len(parts) - pending, misses=pending)
+    corenlp_sentences = iter(corenlp_sentences)
+    for part, grouping in zip(parts, groupings):
+        if grouping is None:
+            actions = parse_corenlp_sentence(part, next(corenlp_sentences), trace)
+        else:
+            trace.event(ACTIONS, 'fast_path', sentence=part)
+            actions = build_actions([grouping], trace)
+            trace.event(ACTIONS, 'actions', actions=actions)
+        for action in actions:
+            yield action
+
+
+def iter_parse_sentences(sentences, log_file=None, corenlp_sentences=None):
+    '''
+    Generator version of parse_sentences: yields the actions of each sentence as soon as that
+    sentence has been handled. corenlp_sentences is an iterable of CoreNLP sentence results, such as
+    StanfordCoreNLP.parse_stream(sentences) of a CoreNLP run in this process, which lets the first
+    actions be produced before the rest of the paragraph has been parsed; by default the result is
+    fetched from the server.
+
+    When fetching from the server, simple sentences are handled by the fast path, and only the
+    others are sent to CoreNLP, in a single request. The actions of the simple sentences before the
+    first of the others are yielded while CoreNLP parses them, so that a paragraph that starts with
+    simple commands produces its first actions without waiting for the server. The steps of the
+    parse are traced to log_file (see get_trace).
+    '''
+    log_file = get_trace(log_file)
+    if corenlp_sentences is None and fast_path is not None:
+        parts, groupings, pending = match_fast_path(sentences)
+        future = get_corenlp_result_async(' '.join(pending)) if pending else None
+        leading = groupings.index(None) if pending else len(parts)
+        for action in iter_mixed_actions(parts[:leading], groupings[:leading], [], log_file):
+            yield action
+        parts, groupings = parts[leading:], groupings[leading:]
+        corenlp_sentences = future.result()['sentences'] if future is not None else []
+        if len(corenlp_sentences) == len(pending):
+            for action in iter_mixed_actions(parts, groupings, corenlp_sentences, log_file):
+                yield action
+            return
+        # CoreNLP split the sentences differently than we did, so their results cannot be lined up;
+        # parse the rest of the text with CoreNLP instead
+        corenlp_sentences = None
+        fast_path.count(misses=len(parts))
+        sentences = ' '.join(parts)
+
+    if corenlp_sentences is None:
+        corenlp_sentences = get_corenlp_result(sentences)['sentences']
+    for sentence in corenlp_sentences:
+        for action in parse_corenlp_sentence(sentences, sentence, log_file):
+            yield action
+
+
 def parse_sentences(sentences, log_file=None):
-    result = get_corenlp_result(sentences)
-    dependencies = get_dependencies(result)
-    words = get_words(result)
-    actions = []
-    for index, dep_list in enumerate(dependencies):
-        word_list = words[index]
-        actions.extend(parse_sentence(sentences, dep_list, word_list, log_file=log_file))
-    return actions
+    return list(iter_parse_sentences(sentences, log_file))
+
+
+def parse_many(documents, log_file=None):
+    '''
+    Parses many documents with few CoreNLP requests, for translating large numbers of them: the
+    sentences the fast path does not handle are packed into requests of up to PACK_CHARS characters
+    (see get_corenlp_results_packed) instead of one request per document. Returns a list with the
+    actions of each document, as parse_sentences would return them, or the exception raised while
+    parsing it, so that one bad document does not fail the others.
+    '''
+    log_file = get_trace(log_file)
+    plans = []
+    for document in documents:
+        if fast_path is None:
+            plans.append((None, None, document))
+        else:
+            parts, groupings, pending = match_fast_path(document)
+            plans.append((parts, groupings, ' '.join(pending)))
+    texts = [text for parts, groupings, text in plans if text]
+    results = iter(get_corenlp_results_packed(texts))
+
+    parsed = []
+    for document, (parts, groupings, text) in zip(documents, plans):
+        result = next(results) if text else {'sentences': []}
+        try:
+            if isinstance(result, Exception):
+                raise result
+            if parts is None:
+                actions = list(iter_parse_sentences(document, log_file, result['sentences']))
+            elif len(result['sentences']) == groupings.count(None):
+                actions = list(iter_mixed_actions(parts, groupings, result['sentences'], log_file))
+            else:
+                # CoreNLP split the sentences differently, see iter_parse_sentences
+                fast_path.count(misses=len(parts))
+                actions = list(iter_parse_sentences(document, log_file,
+                                                    get_corenlp_result(document)['sentences']))
+            parsed.append(actions)
+        except Exception as e:
+            parsed.append(e)
+    return parsed
+
+
+def parse_sentences_async(sentences, log_file=None):
+    '''
+    Asynchronous version of parse_sentences, for services handling many paragraphs at once: returns
+    a jsonrpc.Future of the actions at once. The CoreNLP requests of concurrent calls are sent in
+    parallel, up to CONNECTIONS at a time, and fail with jsonrpc.RPCTimeoutError if the server has
+    not answered after DEADLINE + DEADLINE_SLACK seconds. The actions are built by the thread that
+    received the response.
+    '''
+    future = jsonrpc.Future('parse_sentences')
+    log_file = get_trace(log_file)
+
+    def parse_all(corenlp_future):
+        try:
+            corenlp_sentences = corenlp_future.result()['sentences']
+            future.set_result(list(iter_parse_sentences(sentences, log_file, corenlp_sentences)))
+        except Exception as e:
+            future.set_exception(e)
+
+    def parse_mixed(corenlp_future):
+        try:
+            corenlp_sentences = corenlp_future.result()['sentences']
+            if len(corenlp_sentences) == len(pending):
+                future.set_result(list(iter_mixed_actions(parts, groupings, corenlp_sentences,
+                                                          log_file)))
+                return
+            # CoreNLP split the sentences differently, see iter_parse_sentences
+            fast_path.count(misses=len(parts))
+            get_corenlp_result_async(sentences).add_done_callback(parse_all)
+        except Exception as e:
+            future.set_exception(e)
+
+    if fast_path is None:
+        get_corenlp_result_async(sentences).add_done_callback(parse_all)
+        return future
+    parts, groupings, pending = match_fast_path(sentences)
+    if pending:
+        get_corenlp_result_async(' '.join(pending)).add_done_callback(parse_mixed)
+    else:
+        no_sentences = jsonrpc.Future('annotate')
+        no_sentences.set_result({'sentences': []})
+        parse_mixed(no_sentences)
+    return future
 
 if __name__ == '__main__':
     with open(sys.argv[1]) as f:
         contents = f.read().replace('\n', ' ')
-    parse_sentences(contents)
+    parse_sentences(contents, sys.stdout)
@@ -2,8 +2,15 @@
 
 from __future__ import print_function
 from colorama import Fore, Style
+from enum import Enum
+import json
 import sys
 
+# Levels of detail of a Trace, from nothing at all to every step of the parse
+LEVELS = ['off', 'actions', 'groupings', 'details']
+OFF, ACTIONS, GROUPINGS, DETAILS = range(len(LEVELS))
+FORMATS = ('text', 'json')
+
 
 def info(string):
     print(Fore.CYAN + '[INFO] {}'.format(string) + Style.RESET_ALL, file=sys.stderr)
@@ -19,3 +26,49 @@ def error(string):
 
 def success(string):
     print(Fore.GREEN + '[SUCCESS] {}'.format(string) + Style.RESET_ALL, file=sys.stderr)
+
+
+def to_json(obj):
+    '''Makes the parser's objects serializable: enums by their name, others by their attributes.'''
+    if isinstance(obj, Enum):
+        return obj.name
+    if hasattr(obj, '__dict__'):
+        fields = dict(vars(obj))
+        fields['type'] = obj.__class__.__name__
+        return fields
+    return repr(obj)
+
+
+class Trace:
+    '''
+    Writes the steps of a parse to a stream, either as readable lines ('text') or as one JSON
+    object per line ('json'). An event is only formatted if its level is enabled, so callers pass
+    the objects to show instead of formatted strings, and check enabled() before computing anything
+    just for the trace.
+    '''
+    def __init__(self, stream=None, level=DETAILS, format='text'):
+        if format not in FORMATS:
+            raise ValueError('Unknown trace format {!r}, expected one of {}'.format(format, FORMATS))
+        self.stream = stream
+        self.level = level if stream is not None else OFF
+        self.format = format
+
+    def enabled(self, level):
+        return level <= self.level
+
+    def event(self, level, name, **fields):
+        if level > self.level:
+            return
+        if self.format == 'json':
+            fields['event'] = name
+            fields['level'] = LEVELS[level]
+            line = json.dumps(fields, default=to_json, sort_keys=True)
+        elif len(fields) == 1:
+            line = '{}: {}'.format(name, fields.values()[0])
+        else:
+            line = '{}: {}'.format(name, ', '.join('{}={}'.format(key, fields[key])
+                                                   for key in sorted(fields)))
+        self.stream.write(line + '\n')
+
+# Writes nothing
+NULL_TRACE = Trace()
@@ -0,0 +1,202 @@
+# [SublimeLinter @python:2]
+
+from __future__ import print_function
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+TESTS_DIR = 'tests'
+
+
+def normalize(text):
+    '''Collapses runs of whitespace, so that reformatted sentences share a cache entry.'''
+    return ' '.join(text.split())
+
+
+def result_key(config, text):
+    '''Hashes the normalized text and the configuration it was parsed with.'''
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    digest = hashlib.sha1(config.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(normalize(text).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ParseCache:
+    '''
+    Persistent cache of CoreNLP results in a SQLite database. Results are keyed by a hash of the
+    normalized text and the annotator configuration they were parsed with. Once the cache holds
+    more than max_entries results, the least recently used ones are evicted.
+
+    So that a hit is only a read, the times results were last used are kept in memory and written
+    with the next put, after touch_batch hits, or by flush().
+    '''
+    def __init__(self, path, config='', max_entries=10000, touch_batch=100):
+        self.path = path
+        self.config = config
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS parses '
+                          '(key TEXT PRIMARY KEY, result TEXT, last_used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS parses_last_used ON parses (last_used)')
+        self.conn.commit()
+
+    def key(self, text):
+        return result_key(self.config, text)
+
+    def get(self, text):
+        '''Returns the cached result for text, or None if it has not been cached.'''
+        key = self.key(text)
+        with self.lock:
+            row = self.conn.execute('SELECT result FROM parses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_batch:
+                self._touch()
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, text, result):
+        key = self.key(text)
+        with self.lock:
+            # Evict by up-to-date times
+            self._touch()
+            self.conn.execute('INSERT OR REPLACE INTO parses VALUES (?, ?, ?)',
+                              (key, json.dumps(result), time.time()))
+            excess = self._size() - self.max_entries
+            if excess > 0:
+                self.conn.execute('DELETE FROM parses WHERE key IN '
+                                  '(SELECT key FROM parses ORDER BY last_used LIMIT ?)', (excess,))
+            self.conn.commit()
+
+    def flush(self):
+        '''Writes the times results were last used that are still kept in memory.'''
+        with self.lock:
+            self._touch()
+            self.conn.commit()
+
+    def _touch(self):
+        # Called with the lock held; the caller commits
+        if self.touched:
+            self.conn.executemany('UPDATE parses SET last_used = ? WHERE key = ?',
+                                  [(last_used, key) for key, last_used in self.touched.items()])
+            self.touched = {}
+
+    def size(self):
+        with self.lock:
+            return self._size()
+
+    def _size(self):
+        return self.conn.execute('SELECT COUNT(*) FROM parses').fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            self.touched = {}
+            self.conn.execute('DELETE FROM parses')
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': self._size()}
+
+    def export(self, fixtures):
+        '''Copies every cached result into a FixtureStore.'''
+        with self.lock:
+            rows = self.conn.execute('SELECT key, result FROM parses').fetchall()
+        for key, result in rows:
+            fixtures.write(key, None, json.loads(result))
+        return len(rows)
+
+
+class FixtureStore:
+    '''
+    Recorded CoreNLP results, one JSON file per sentence in a directory, so that they can be
+    checked in and replayed without a CoreNLP server. Files are named after the same key as the
+    ParseCache uses, so results recorded with another configuration are never replayed.
+    '''
+    def __init__(self, path, config=''):
+        self.path = path
+        self.config = config
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, text):
+        '''Returns the recorded result for text, or None if it has not been recorded.'''
+        try:
+            with open(self.filename(result_key(self.config, text))) as f:
+                return json.load(f)['result']
+        except IOError:
+            return None
+
+    def put(self, text, result):
+        self.write(result_key(self.config, text), normalize(text), result)
+
+    def write(self, key, text, result):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(self.filename(key), 'w') as f:
+            json.dump({'text': text, 'config': self.config, 'result': result}, f, indent=1,
+                      sort_keys=True)
+
+
+def warm(tests_dir=TESTS_DIR):
+    '''
+    Parses every test sentence, so that they are all in the cache. Like parse_sentences, sends only
+    the sentences the fast path does not handle, so that the results are cached under the same text.
+    '''
+    import kjr_parser
+    texts = []
+    for filename in sorted(glob.glob(os.path.join(tests_dir, 'test-*.txt'))):
+        with open(filename) as f:
+            text = f.read().replace('\n', ' ')
+        if kjr_parser.fast_path is not None:
+            text = ' '.join(kjr_parser.match_fast_path(text)[2])
+        if text:
+            texts.append(text)
+    kjr_parser.get_corenlp_results(texts)
+    return kjr_parser.parser.get_cache()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Manages the CoreNLP parse cache.')
+    arg_parser.add_argument('command', choices=['warm', 'stats', 'clear', 'export'],
+                            help='warm: parse all test sentences into the cache; stats: print '
+                                 'the number of cached results; clear: empty the cache; export: '
+                                 'copy the cached results into the replay fixtures')
+    arg_parser.add_argument('--fixtures', default=None,
+                            help='Fixture directory to export to (default: tests/fixtures)')
+    args = arg_parser.parse_args()
+    import kjr_parser
+    cache = kjr_parser.parser.get_cache()
+    if cache is None:
+        print('The parse cache is disabled')
+    elif args.command == 'warm':
+        warm()
+        print('Warmed {}: {}'.format(cache.path, cache.stats()))
+    elif args.command == 'stats':
+        print('{}: {}'.format(cache.path, cache.stats()))
+    elif args.command == 'clear':
+        cache.clear()
+        print('Cleared {}'.format(cache.path))
+    elif args.command == 'export':
+        fixtures = kjr_parser.parser.fixtures
+        if args.fixtures is not None:
+            fixtures = FixtureStore(args.fixtures, kjr_parser.CACHE_CONFIG)
+        count = cache.export(fixtures)
+        print('Exported {} results to {}'.format(count, fixtures.path))
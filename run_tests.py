@@ -12,6 +12,7 @@ import re
 import os
 from collections import namedtuple
 import argparse
+import time
 import traceback
 
 TESTS_DIR = 'tests'
@@ -20,17 +21,25 @@ BeeperPos = namedtuple('BeeperPos', ['x', 'y', 'num'])
 RobotPos = namedtuple('RobotPos', ['x', 'y', 'direction', 'beepers'])
 
 
-def run_test_number(test_number):
-    info('Running test {}'.format(test_number))
-    with open('test-{}.txt'.format(test_number), 'r') as f, open('test-{}.log'.format(test_number), 'w') as log_file, open('start-{}.kwld'.format(test_number)) as start_kwld:
-        contents = f.read().replace('\n', ' ')
-        info('Parsing sentence: {}'.format(contents))
-        try:
-            actions = kjr_parser.parse_sentences(contents, log_file)
-        except Exception:
-            error('Exception while parsing sentence')
-            traceback.print_exc()
-            return 0
+def read_test(test_number):
+    with open('test-{}.txt'.format(test_number), 'r') as f:
+        return f.read().replace('\n', ' ')
+
+
+def generate_test_code(test_number, actions=None):
+    '''Parses test-n.txt and generates TestRobotn.java from it. Returns the file name, or None if
+    the sentence could not be parsed. If the actions have already been parsed, they are used
+    instead.'''
+    with open('test-{}.log'.format(test_number), 'w') as log_file, open('start-{}.kwld'.format(test_number)) as start_kwld:
+        if actions is None:
+            contents = read_test(test_number)
+            info('Parsing sentence: {}'.format(contents))
+            try:
+                actions = kjr_parser.parse_sentences(contents, log_file)
+            except Exception:
+                error('Exception while parsing sentence')
+                traceback.print_exc()
+                return None
         robot_pattern = re.compile(r'robot (\d+) (\d+) (\w+) (\d+)')
         robot = None
         for line in start_kwld:
@@ -48,7 +57,14 @@ def run_test_number(test_number):
                           beepers=robot.beepers)
         else:
             generate_code(actions, test_number, 'TestRobot.template', java_file)
+    return java_file
 
+
+def run_test_number(test_number):
+    info('Running test {}'.format(test_number))
+    java_file = generate_test_code(test_number)
+    if java_file is None:
+        return 0
     with open('test-{}.log'.format(test_number), 'a') as log_file:
         info('Compiling {}'.format(java_file))
         ret = subprocess.call(['javac', '-cp', '.:KarelJRobot.jar', java_file], stdout=log_file, stderr=log_file)
@@ -128,8 +144,43 @@ def evaluate(test_kwld, ref_kwld):
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='Runs tests.')
     arg_parser.add_argument('tests', type=int, nargs='*', help='Test numbers to run')
+    arg_parser.add_argument('--backend', choices=kjr_parser.BACKENDS, default=None,
+                            help='Where to get CoreNLP results from: the server, the server while '
+                                 'recording them as fixtures, or only the recorded fixtures '
+                                 '(default: $KJR_BACKEND or server)')
+    arg_parser.add_argument('--fixtures', default=None,
+                            help='Fixture directory to record to or replay from '
+                                 '(default: $KJR_FIXTURES or tests/fixtures)')
+    arg_parser.add_argument('--parse-only', action='store_true',
+                            help='Only parse the tests and generate their code, without compiling '
+                                 'and running it, and print how long that took')
+    arg_parser.add_argument('--many', action='store_true',
+                            help='With --parse-only, parse all tests with a single '
+                                 'kjr_parser.parse_many() call')
     args = arg_parser.parse_args()
+    if args.backend is not None or args.fixtures is not None:
+        kjr_parser.parser.use_backend(args.backend or kjr_parser.parser.backend,
+                                      os.path.abspath(args.fixtures) if args.fixtures else None)
     os.chdir(TESTS_DIR)
+    if args.parse_only:
+        if len(args.tests) == 0:
+            args.tests = sorted(int(re.match(r'.*-(\d+)\.txt', file).group(1))
+                                for file in glob.glob('*.txt'))
+        start = time.time()
+        if args.many:
+            with open(os.devnull, 'w') as log_file:
+                parsed = kjr_parser.parse_many([read_test(test) for test in args.tests], log_file)
+            failed_tests = [test for test, actions in zip(args.tests, parsed)
+                            if isinstance(actions, Exception) or
+                            generate_test_code(test, actions) is None]
+        else:
+            failed_tests = [test for test in args.tests if generate_test_code(test) is None]
+        elapsed = time.time() - start
+        print('Parsed {} tests in {:.3f} s ({:.1f} ms per test)'.format(
+            len(args.tests), elapsed, elapsed / max(len(args.tests), 1) * 1000))
+        if failed_tests:
+            print('Failed to parse: {}'.format(failed_tests))
+        sys.exit(1 if failed_tests else 0)
     score = 0
     total = len(glob.glob('*.txt'))
     successful_tests = []
@@ -147,6 +198,11 @@ if __name__ == '__main__':
         print('Score: {} / {} ({}%)'.format(score, total, score / total * 100))
         print('Successful tests: {}'.format(sorted(successful_tests)))
         print('Failed tests: {}'.format(sorted(failed_tests)))
+        cache = kjr_parser.parser.get_cache()
+        if cache is not None:
+            print('Parse cache: {}'.format(cache.stats()))
+        if kjr_parser.fast_path is not None:
+            print('Fast path: {}'.format(kjr_parser.fast_path.stats()))
     else:
         for test in args.tests:
             run_test_number(test)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the CoreNLP wrapper.
+
+    python benchmark.py results [-n SENTENCES] [-r REPEAT]
+
+times parse_parser_results() on a synthetic shell transcript, with and
+without the optional sections, and reports the cost per sentence. The
+line-by-line parser it replaced is kept below as baseline_parser_results(),
+timed on the same transcript, and checked to give the same results.
+
+    python benchmark.py latency [-c REQUESTS] [--profile PROFILE]
+
+starts CoreNLP, sends it a short sentence REQUESTS times and prints a
+histogram of the round-trip latencies of StanfordCoreNLP._parse().
+"""
+
+import optparse
+import re
+import time
+import timeit
+
+from corenlp import parse_parser_results, StanfordCoreNLP, PROFILES, CR_PATTERN, WORD_PATTERN
+
+
+SAMPLE_SENTENCE = """Sentence #%(n)d (9 tokens):
+If Karel is facing north, move two spaces forward.
+[Text=If CharacterOffsetBegin=0 CharacterOffsetEnd=2 PartOfSpeech=IN Lemma=if NamedEntityTag=O] [Text=Karel CharacterOffsetBegin=3 CharacterOffsetEnd=8 PartOfSpeech=NNP Lemma=Karel NamedEntityTag=PERSON] [Text=is CharacterOffsetBegin=9 CharacterOffsetEnd=11 PartOfSpeech=VBZ Lemma=be NamedEntityTag=O] [Text=facing CharacterOffsetBegin=12 CharacterOffsetEnd=18 PartOfSpeech=VBG Lemma=face NamedEntityTag=O] [Text=north CharacterOffsetBegin=19 CharacterOffsetEnd=24 PartOfSpeech=RB Lemma=north NamedEntityTag=O] [Text=, CharacterOffsetBegin=24 CharacterOffsetEnd=25 PartOfSpeech=, Lemma=, NamedEntityTag=O] [Text=move CharacterOffsetBegin=26 CharacterOffsetEnd=30 PartOfSpeech=VB Lemma=move NamedEntityTag=O] [Text=two CharacterOffsetBegin=31 CharacterOffsetEnd=34 PartOfSpeech=CD Lemma=two NamedEntityTag=NUMBER NormalizedNamedEntityTag=2.0] [Text=spaces CharacterOffsetBegin=35 CharacterOffsetEnd=41 PartOfSpeech=NNS Lemma=space NamedEntityTag=O] [Text=forward CharacterOffsetBegin=42 CharacterOffsetEnd=49 PartOfSpeech=RB Lemma=forward NamedEntityTag=O] [Text=. CharacterOffsetBegin=49 CharacterOffsetEnd=50 PartOfSpeech=. Lemma=. NamedEntityTag=O]
+(ROOT
+  (S
+    (SBAR (IN If)
+      (S
+        (NP (NNP Karel))
+        (VP (VBZ is)
+          (VP (VBG facing)
+            (ADVP (RB north))))))
+    (, ,)
+    (VP (VB move)
+      (NP (CD two) (NNS spaces))
+      (ADVP (RB forward)))
+    (. .)))
+
+mark(facing-4, If-1)
+nsubj(facing-4, Karel-2)
+aux(facing-4, is-3)
+advcl(move-7, facing-4)
+advmod(facing-4, north-5)
+root(ROOT-0, move-7)
+num(spaces-9, two-8)
+dobj(move-7, spaces-9)
+advmod(move-7, forward-10)
+"""
+
+SAMPLE_COREF = """Coreference set:
+\t(2,2,[2,3]) -> (1,2,[2,3]), that is: "Karel" -> "Karel"
+"""
+
+
+def make_transcript(n_sentences):
+    """Builds the shell output for a document of n_sentences sentences."""
+    text = "\n".join(SAMPLE_SENTENCE % {'n': i + 1} for i in range(n_sentences))
+    return "%s\n%s\nNLP> " % (text, SAMPLE_COREF)
+
+
+# The parser as it was before the single-pass rewrite, for comparison
+
+STATE_START, STATE_TEXT, STATE_WORDS, STATE_TREE, STATE_DEPENDENCY, STATE_COREFERENCE = 0, 1, 2, 3, 4, 5
+
+
+def baseline_remove_id(word):
+    return word.count("-") == 0 and word or (word[0:word.rindex("-")], int(word[word.rindex("-") + 1:]))
+
+
+def baseline_parse_bracketed(s):
+    word = None
+    attrs = {}
+    temp = {}
+    for i, tag in enumerate(re.findall(r"(<[^<>]+>.*<\/[^<>]+>)", s)):
+        temp["^^^%d^^^" % i] = tag
+        s = s.replace(tag, "^^^%d^^^" % i)
+    for attr, val in re.findall(r"([^=\s]*)=([^=\s]*)", s):
+        if val in temp:
+            val = temp[val]
+        if attr == 'Text':
+            word = val
+        else:
+            attrs[attr] = val
+    return (word, attrs)
+
+
+def baseline_parser_results(text):
+    results = {"sentences": []}
+    state = STATE_START
+    for line in text.encode('utf-8').split("\n"):
+        line = line.strip()
+
+        if line.startswith("Sentence #"):
+            sentence = {'words':[], 'parsetree':[], 'dependencies':[]}
+            results["sentences"].append(sentence)
+            state = STATE_TEXT
+
+        elif state == STATE_TEXT:
+            sentence['text'] = line
+            state = STATE_WORDS
+
+        elif state == STATE_WORDS:
+            if not line.startswith("[Text="):
+                raise Exception('Parse error. Could not find "[Text=" in: %s' % line)
+            for s in WORD_PATTERN.findall(line):
+                sentence['words'].append(baseline_parse_bracketed(s))
+            state = STATE_TREE
+
+        elif state == STATE_TREE:
+            if len(line) == 0:
+                state = STATE_DEPENDENCY
+                sentence['parsetree'] = " ".join(sentence['parsetree'])
+            else:
+                sentence['parsetree'].append(line)
+
+        elif state == STATE_DEPENDENCY:
+            if len(line) == 0:
+                state = STATE_COREFERENCE
+            else:
+                split_entry = re.split("\(|, ", line[:-1])
+                if len(split_entry) == 3:
+                    rel, left, right = map(lambda x: baseline_remove_id(x), split_entry)
+                    sentence['dependencies'].append(tuple([rel,left,right]))
+
+        elif state == STATE_COREFERENCE:
+            if "Coreference set" in line:
+                if 'coref' not in results:
+                    results['coref'] = []
+                coref_set = []
+                results['coref'].append(coref_set)
+            else:
+                for src_i, src_pos, src_l, src_r, sink_i, sink_pos, sink_l, sink_r, src_word, sink_word in CR_PATTERN.findall(line):
+                    src_i, src_pos, src_l, src_r = int(src_i)-1, int(src_pos)-1, int(src_l)-1, int(src_r)-1
+                    sink_i, sink_pos, sink_l, sink_r = int(sink_i)-1, int(sink_pos)-1, int(sink_l)-1, int(sink_r)-1
+                    coref_set.append(((src_word, src_i, src_pos, src_l, src_r), (sink_word, sink_i, sink_pos, sink_l, sink_r)))
+
+    return results
+
+
+def time_per_sentence(parse, transcript, n_sentences, repeat):
+    """Returns the best time per sentence of parse(transcript), in microseconds."""
+    timer = timeit.Timer(lambda: parse(transcript))
+    loops = max(1, 2000 // n_sentences)
+    return min(timer.repeat(repeat, loops)) / loops / n_sentences * 1e6
+
+
+def bench_results(n_sentences, repeat):
+    transcript = make_transcript(n_sentences)
+    if parse_parser_results(transcript) != baseline_parser_results(transcript):
+        raise AssertionError("parse_parser_results() and the baseline parser disagree")
+    baseline = time_per_sentence(baseline_parser_results, transcript, n_sentences, repeat)
+    print "baseline parser: %.1f us/sentence (%d sentences, best of %d)" % (
+        baseline, n_sentences, repeat)
+    for kwargs in [{}, {'parsetree': False, 'coref': False}]:
+        best = time_per_sentence(lambda text: parse_parser_results(text, **kwargs),
+                                 transcript, n_sentences, repeat)
+        print "parse_parser_results(%s): %.1f us/sentence, %.1fx the baseline's speed" % (
+            ", ".join("%s=%s" % item for item in sorted(kwargs.items())), best, baseline / best)
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def print_histogram(samples, buckets=LATENCY_BUCKETS, width=50):
+    """Prints a text histogram of samples (in milliseconds)."""
+    counts = [0] * (len(buckets) + 1)
+    for sample in samples:
+        i = 0
+        while i < len(buckets) and sample > buckets[i]:
+            i += 1
+        counts[i] += 1
+    labels = ["<= %d ms" % bound for bound in buckets] + ["> %d ms" % buckets[-1]]
+    for label, count in zip(labels, counts):
+        print "%10s | %-*s %d" % (label, width, "#" * (count * width // len(samples)), count)
+
+
+def bench_latency(requests, profile, corenlp_path=None):
+    nlp = StanfordCoreNLP(corenlp_path, profile)
+    samples = []
+    for i in range(requests):
+        start = time.time()
+        nlp._parse("Karel should move two spaces north.")
+        samples.append((time.time() - start) * 1000)
+    samples.sort()
+    print "StanfordCoreNLP._parse(): min %.1f ms, median %.1f ms, max %.1f ms (%d requests)" % (
+        samples[0], samples[len(samples) // 2], samples[-1], requests)
+    print_histogram(samples)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog results|latency [OPTIONS]")
+    parser.add_option('-n', '--sentences', type='int', default=10,
+                      help='Sentences per document (default: 10)')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='Number of timing runs to take the best of (default: 5)')
+    parser.add_option('-c', '--requests', type='int', default=100,
+                      help='Number of requests for the latency benchmark (default: 100)')
+    parser.add_option('--profile', default='karel', choices=sorted(PROFILES.keys()),
+                      help='Annotator profile for the latency benchmark (default: karel)')
+    parser.add_option('--corenlp-path', default=None,
+                      help='Directory containing the CoreNLP jars')
+    options, args = parser.parse_args()
+    if args == ['results']:
+        bench_results(options.sentences, options.repeat)
+    elif args == ['latency']:
+        bench_latency(options.requests, options.profile, options.corenlp_path)
+    else:
+        parser.error('unknown benchmark')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+A compact encoding of parse results, for sending them over JSON-RPC.
+
+In the usual format every word is a [word, {attribute: value}] pair, so
+the attribute names are repeated for every word, and every dependency
+repeats the words it connects. The compact format stores the words of a
+sentence as columns instead (one list of words and one list of values
+per attribute), and dependencies as [relation, governor, dependent]
+word indexes, which roughly halves the size of a result and the time to
+serialize it. decode() restores the usual format.
+
+This module does not depend on pexpect, so clients can use it without
+the server's dependencies.
+"""
+
+FORMAT = 'compact-1'
+
+
+def encode(results):
+    """
+    Returns results (as returned by StanfordCoreNLP._parse()) in the
+    compact format. Errors are returned unchanged.
+    """
+    if 'sentences' not in results:
+        return results
+    encoded = dict(results)
+    encoded['format'] = FORMAT
+    encoded['sentences'] = [encode_sentence(sentence) for sentence in results['sentences']]
+    return encoded
+
+
+def encode_sentence(sentence):
+    tokens = []
+    columns = {}
+    for i, (word, attrs) in enumerate(sentence['words']):
+        tokens.append(word)
+        for attr, value in attrs.iteritems():
+            column = columns.get(attr)
+            if column is None:
+                column = columns[attr] = [None] * i
+            column.append(value)
+        for column in columns.itervalues():
+            if len(column) <= i:
+                column.append(None)
+    dependencies = []
+    for rel, (governor, gov_index), (dependent, dep_index) in sentence['dependencies']:
+        # the words are left out if they can be looked up by their index
+        if word_at(tokens, gov_index) == governor and word_at(tokens, dep_index) == dependent:
+            dependencies.append([rel, gov_index, dep_index])
+        else:
+            dependencies.append([rel, gov_index, dep_index, governor, dependent])
+    encoded = dict(sentence)
+    encoded['words'] = {'tokens': tokens, 'attrs': columns}
+    encoded['dependencies'] = dependencies
+    return encoded
+
+
+def word_at(tokens, index):
+    """Returns the word a dependency refers to by its (1-based) index; 0 is ROOT."""
+    if index == 0:
+        return 'ROOT'
+    if 0 < index <= len(tokens):
+        return tokens[index - 1]
+    return None
+
+
+def decode(results):
+    """
+    Returns results in the usual format, whether they are in the compact
+    format or not.
+    """
+    if results.get('format') != FORMAT:
+        return results
+    decoded = dict(results)
+    del decoded['format']
+    decoded['sentences'] = [decode_sentence(sentence) for sentence in results['sentences']]
+    return decoded
+
+
+def decode_sentence(sentence):
+    tokens = sentence['words']['tokens']
+    columns = sentence['words']['attrs'].items()
+    words = []
+    for i, word in enumerate(tokens):
+        words.append([word, dict((attr, column[i]) for attr, column in columns
+                                 if column[i] is not None)])
+    dependencies = []
+    for dependency in sentence['dependencies']:
+        rel, gov_index, dep_index = dependency[:3]
+        if len(dependency) > 3:
+            governor, dependent = dependency[3:]
+        else:
+            governor, dependent = word_at(tokens, gov_index), word_at(tokens, dep_index)
+        dependencies.append([rel, [governor, gov_index], [dependent, dep_index]])
+    decoded = dict(sentence)
+    decoded['words'] = words
+    decoded['dependencies'] = dependencies
+    return decoded
@@ -18,10 +18,18 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import atexit
+import codecs
 import json
 import optparse
 import os, re, sys, time, traceback
-import jsonrpc, pexpect
+import Queue
+import shutil, subprocess, tempfile, threading
+from collections import OrderedDict, deque
+import xml.etree.cElementTree as ElementTree
+import jsonrpc, pexpect, tracing
+from metrics import Metrics, serve_http
+from compact import encode as encode_compact
 from progressbar import ProgressBar, Fraction
 import logging
 
@@ -30,8 +38,37 @@ VERBOSE = True
 
 STATE_START, STATE_TEXT, STATE_WORDS, STATE_TREE, STATE_DEPENDENCY, STATE_COREFERENCE = 0, 1, 2, 3, 4, 5
 WORD_PATTERN = re.compile('\[([^\]]+)\]')
+DEPENDENCY_PATTERN = re.compile(r"^(\S+?)\((.+)-(\d+)'*, (.+)-(\d+)'*\)$")
+ATTR_PATTERN = re.compile(r"([^=\s]*)=([^=\s]*)")
+XML_PATTERN = re.compile(r"(<[^<>]+>.*<\/[^<>]+>)")
 CR_PATTERN = re.compile(r"\((\d*),(\d)*,\[(\d*),(\d*)\]\) -> \((\d*),(\d)*,\[(\d*),(\d*)\]\), that is: \"(.*)\" -> \"(.*)\"")
 
+# The interactive shell prints this after every response
+PROMPT = "\nNLP> "
+
+# Annotator profiles: properties file and JVM heap size
+PROFILES = {
+    'default': ('default.properties', '1800m'),
+    'karel': ('karel.properties', '1g'),
+}
+
+# How many models each annotator loads at startup (CoreNLP prints "done."
+# after each one)
+MODEL_LOADS = {'pos': 1, 'ner': 3, 'parse': 1}
+
+# Error returned instead of parsing when the client's deadline has already
+# passed, e.g. while the request was waiting for a worker
+CANCELLED = "cancelled: the client's deadline has passed"
+
+# The interactive shell reads one line per document, and the terminal it
+# runs in cuts lines at 4096 bytes; longer texts are sent in pieces
+MAX_LINE = 4000
+SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s')
+
+# Token attributes in CoreNLP's XML output, renamed to match the text output
+XML_WORD_ATTRS = {'lemma': 'Lemma', 'POS': 'PartOfSpeech', 'NER': 'NamedEntityTag',
+                  'NormalizedNER': 'NormalizedNamedEntityTag'}
+
 # initialize logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -51,11 +88,12 @@ def parse_bracketed(s):
     attrs = {}
     temp = {}
     # Substitute XML tags, to replace them later
-    for i, tag in enumerate(re.findall(r"(<[^<>]+>.*<\/[^<>]+>)", s)):
-        temp["^^^%d^^^" % i] = tag
-        s = s.replace(tag, "^^^%d^^^" % i)
+    if "<" in s:
+        for i, tag in enumerate(XML_PATTERN.findall(s)):
+            temp["^^^%d^^^" % i] = tag
+            s = s.replace(tag, "^^^%d^^^" % i)
     # Load key-value pairs, substituting as necessary
-    for attr, val in re.findall(r"([^=\s]*)=([^=\s]*)", s):
+    for attr, val in ATTR_PATTERN.findall(s):
         if val in temp:
             val = temp[val]
         if attr == 'Text':
@@ -65,22 +103,112 @@ def parse_bracketed(s):
     return (word, attrs)
 
 
-def parse_parser_results(text):
+def read_annotators(props):
+    """Returns the list of annotators configured in a properties file"""
+    annotators = []
+    with open(props) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("annotators") and "=" in line:
+                annotators = [a.strip() for a in line.split("=", 1)[1].split(",") if a.strip()]
+    return annotators
+
+
+def split_lines(text, max_length=MAX_LINE):
+    """
+    Splits text into lines for the interactive shell: newlines become
+    spaces, and texts longer than max_length bytes are split after the
+    last sentence end (or else the last space) that fits.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    text = ' '.join(text.splitlines())
+    lines = []
+    while len(text) > max_length:
+        ends = [m.end() for m in SENTENCE_END.finditer(text, 0, max_length + 1)]
+        end = ends[-1] if ends else text.rfind(' ', 0, max_length + 1) + 1
+        if end <= 0:
+            end = max_length
+        lines.append(text[:end])
+        text = text[end:]
+    lines.append(text)
+    return lines
+
+
+def merge_results(results, more):
+    """
+    Appends the results of a later piece of the same text, shifting the
+    sentence numbers in its coreference sets.
+    """
+    offset = len(results['sentences'])
+    results['sentences'].extend(more['sentences'])
+    for coref_set in more.get('coref', []):
+        results.setdefault('coref', []).append(
+            [tuple((mention[0], mention[1] + offset) + mention[2:] for mention in pair)
+             for pair in coref_set])
+    return results
+
+
+def parse_parser_results(text, parsetree=True, coref=True):
     """ This is the nasty bit of code to interact with the command-line
     interface of the CoreNLP tools.  Takes a string of the parser results
     and then returns a Python list of dictionaries, one for each parsed
     sentence.
+
+    The output is read in a single pass. Sections the caller does not ask
+    for (the parse tree and coreference sets) are skipped without being
+    parsed, and are left out of the result.
     """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
     results = {"sentences": []}
+    results["sentences"].extend(iter_parser_results(text.splitlines(), results, parsetree, coref))
+    return results
+
+
+def iter_parser_results(lines, results, parsetree=True, coref=True):
+    """
+    Incremental version of parse_parser_results(): reads the shell output
+    from an iterable of lines and yields each sentence as soon as its
+    dependencies have been read. Coreference sets, which are printed after
+    all sentences, are added to the `results` dict instead.
+    """
     state = STATE_START
-    for line in text.encode('utf-8').split("\n"):
+    sentence = None
+    match_dependency = DEPENDENCY_PATTERN.match
+    find_words = WORD_PATTERN.findall
+    for line in lines:
         line = line.strip()
 
         if line.startswith("Sentence #"):
-            sentence = {'words':[], 'parsetree':[], 'dependencies':[]}
-            results["sentences"].append(sentence)
+            if sentence is not None:
+                yield sentence
+            sentence = {'words': [], 'dependencies': []}
+            if parsetree:
+                sentence['parsetree'] = tree = []
+            words = sentence['words']
+            dependencies = sentence['dependencies']
             state = STATE_TEXT
 
+        elif state == STATE_DEPENDENCY:
+            if not line:
+                state = STATE_COREFERENCE if coref else STATE_START
+                yield sentence
+                sentence = None
+            else:
+                m = match_dependency(line)
+                if m is not None:
+                    rel, left, left_id, right, right_id = m.groups()
+                    dependencies.append((rel, (left, int(left_id)), (right, int(right_id))))
+
+        elif state == STATE_TREE:
+            if not line:
+                state = STATE_DEPENDENCY
+                if parsetree:
+                    sentence['parsetree'] = " ".join(tree)
+            elif parsetree:
+                tree.append(line)
+
         elif state == STATE_TEXT:
             sentence['text'] = line
             state = STATE_WORDS
@@ -88,26 +216,21 @@ def parse_parser_results(text):
         elif state == STATE_WORDS:
             if not line.startswith("[Text="):
                 raise Exception('Parse error. Could not find "[Text=" in: %s' % line)
-            for s in WORD_PATTERN.findall(line):
-                sentence['words'].append(parse_bracketed(s))
+            for s in find_words(line):
+                if "<" in s:
+                    words.append(parse_bracketed(s))
+                    continue
+                word = None
+                attrs = {}
+                for item in s.split():
+                    attr, _, val = item.partition("=")
+                    if attr == 'Text':
+                        word = val
+                    else:
+                        attrs[attr] = val
+                words.append((word, attrs))
             state = STATE_TREE
 
-        elif state == STATE_TREE:
-            if len(line) == 0:
-                state = STATE_DEPENDENCY
-                sentence['parsetree'] = " ".join(sentence['parsetree'])
-            else:
-                sentence['parsetree'].append(line)
-
-        elif state == STATE_DEPENDENCY:
-            if len(line) == 0:
-                state = STATE_COREFERENCE
-            else:
-                split_entry = re.split("\(|, ", line[:-1])
-                if len(split_entry) == 3:
-                    rel, left, right = map(lambda x: remove_id(x), split_entry)
-                    sentence['dependencies'].append(tuple([rel,left,right]))
-
         elif state == STATE_COREFERENCE:
             if "Coreference set" in line:
                 if 'coref' not in results:
@@ -120,126 +243,708 @@ def parse_parser_results(text):
                     sink_i, sink_pos, sink_l, sink_r = int(sink_i)-1, int(sink_pos)-1, int(sink_l)-1, int(sink_r)-1
                     coref_set.append(((src_word, src_i, src_pos, src_l, src_r), (sink_word, sink_i, sink_pos, sink_l, sink_r)))
 
+    if sentence is not None:
+        yield sentence
+
+
+def parse_xml_results(source, text):
+    """
+    Reads one document of CoreNLP's XML output (a file name or file object)
+    into the same structure parse_parser_results() returns. `text` is the
+    input document, which the sentence texts are cut out of. The XML is
+    parsed incrementally, so each sentence is discarded once converted.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    results = {"sentences": []}
+    for event, elem in ElementTree.iterparse(source):
+        if elem.tag == 'sentence' and elem.find('tokens') is not None:
+            sentence = {'words': [], 'parsetree': '', 'dependencies': []}
+            for token in elem.find('tokens'):
+                attrs = {}
+                for child in token:
+                    if child.tag != 'word':
+                        attrs[XML_WORD_ATTRS.get(child.tag, child.tag)] = child.text
+                sentence['words'].append((token.findtext('word'), attrs))
+            if sentence['words']:
+                begin = int(sentence['words'][0][1]['CharacterOffsetBegin'])
+                end = int(sentence['words'][-1][1]['CharacterOffsetEnd'])
+                sentence['text'] = text[begin:end]
+            else:
+                sentence['text'] = ''
+            parse = elem.find('parse')
+            if parse is not None and parse.text:
+                sentence['parsetree'] = parse.text.strip()
+            for deps in elem.findall('dependencies'):
+                if deps.get('type') == 'collapsed-ccprocessed-dependencies':
+                    for dep in deps:
+                        governor, dependent = dep.find('governor'), dep.find('dependent')
+                        sentence['dependencies'].append((dep.get('type'),
+                                                         (governor.text, int(governor.get('idx'))),
+                                                         (dependent.text, int(dependent.get('idx')))))
+            results['sentences'].append(sentence)
+            elem.clear()
+        elif elem.tag == 'coreference' and elem.find('mention') is not None:
+            mentions = []
+            for mention in elem.findall('mention'):
+                mentions.append(((mention.findtext('text'),
+                                  int(mention.findtext('sentence')) - 1,
+                                  int(mention.findtext('head')) - 1,
+                                  int(mention.findtext('start')) - 1,
+                                  int(mention.findtext('end')) - 1),
+                                 mention.get('representative') == 'true'))
+            representative = [m for m, is_rep in mentions if is_rep]
+            if representative:
+                if 'coref' not in results:
+                    results['coref'] = []
+                results['coref'].append([(m, representative[0]) for m, is_rep in mentions if not is_rep])
+            elem.clear()
     return results
 
 
+def parse_batch(texts, corenlp_path=None, profile='default'):
+    """
+    Annotates many documents with a single CoreNLP run instead of one
+    interactive round trip each: the texts are written to a temporary
+    directory and CoreNLP is started once with -filelist and XML output.
+
+    This is a generator that yields one result per text, in order and in
+    the format of parse_parser_results(), as soon as CoreNLP has finished
+    writing it.
+    """
+    texts = list(texts)
+    tmpdir = tempfile.mkdtemp(prefix='corenlp-')
+    try:
+        inputs = []
+        for i, text in enumerate(texts):
+            name = os.path.join(tmpdir, "%06d.txt" % i)
+            with codecs.open(name, 'w', encoding='utf-8') as f:
+                f.write(text if isinstance(text, unicode) else text.decode('utf-8'))
+            inputs.append(name)
+        filelist = os.path.join(tmpdir, "filelist.txt")
+        with open(filelist, 'w') as f:
+            f.write("\n".join(inputs))
+        outdir = os.path.join(tmpdir, "out")
+        os.mkdir(outdir)
+        outputs = [os.path.join(outdir, os.path.basename(name) + ".xml") for name in inputs]
+
+        command = corenlp_command(corenlp_path, profile) + \
+            ["-filelist", filelist, "-outputFormat", "xml", "-outputDirectory", outdir]
+        if VERBOSE:
+            logger.debug(" ".join(command))
+        log_name = os.path.join(tmpdir, "corenlp.log")
+        with open(log_name, 'w') as log:
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            for i, output in enumerate(outputs):
+                # CoreNLP annotates the files in order, so a document is
+                # complete once the next one appears or the process exits
+                following = outputs[i + 1] if i + 1 < len(outputs) else None
+                while process.poll() is None and not (following and os.path.exists(following)):
+                    time.sleep(0.05)
+                if not os.path.exists(output):
+                    with open(log_name) as log:
+                        logger.error(log.read())
+                    raise Exception('CoreNLP exited with code %s before annotating document %d'
+                                    % (process.returncode, i))
+                yield parse_xml_results(output, texts[i])
+        finally:
+            if process.poll() is None:
+                process.kill()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def corenlp_command(corenlp_path=None, profile='default'):
+    """
+    Checks the location of the jar files and returns the command line that
+    starts CoreNLP with the given profile, as a list of arguments.
+    """
+    jars = ["stanford-corenlp-3.4.1.jar",
+            "stanford-corenlp-3.4.1-models.jar",
+            "joda-time.jar",
+            "xom.jar",
+            "jollyday.jar"]
+
+    # if CoreNLP libraries are in a different directory,
+    # change the corenlp_path variable to point to them
+    if not corenlp_path:
+        corenlp_path = "./stanford-corenlp-full-2014-08-27/"
+
+    java_path = "java"
+    classname = "edu.stanford.nlp.pipeline.StanfordCoreNLP"
+    # include the properties file, so you can change defaults
+    # but any changes in output format will break parse_parser_results()
+    props_file, memory = PROFILES[profile]
+
+    # add and check classpaths
+    jars = [corenlp_path + jar for jar in jars]
+    for jar in jars:
+        if not os.path.exists(jar):
+            logger.error("Error! Cannot locate %s" % jar)
+            sys.exit(1)
+
+    return [java_path, "-Xmx%s" % memory, "-cp", ':'.join(jars), classname, "-props", props_file]
+
+
 class StanfordCoreNLP(object):
     """
     Command-line interaction with Stanford's CoreNLP java utilities.
     Can be run as a JSON-RPC server or imported as a module.
     """
-    def __init__(self, corenlp_path=None):
+    def __init__(self, corenlp_path=None, profile='default', metrics=None, timeouts=None):
         """
         Checks the location of the jar files.
         Spawns the server as a process.
+
+        `profile` is one of PROFILES and selects the annotators to load.
+        If `metrics` (a metrics.Metrics) is given, timeouts and the time
+        spent waiting for CoreNLP and parsing its output are recorded.
+        `timeouts` is the LatencyModel that decides how long a request may
+        take; processes can share one. By default each has its own.
         """
-        jars = ["stanford-corenlp-3.4.1.jar",
-                "stanford-corenlp-3.4.1-models.jar",
-                "joda-time.jar",
-                "xom.jar",
-                "jollyday.jar"]
-
-        # if CoreNLP libraries are in a different directory,
-        # change the corenlp_path variable to point to them
-        if not corenlp_path:
-            corenlp_path = "./stanford-corenlp-full-2014-08-27/"
-
-        java_path = "java"
-        classname = "edu.stanford.nlp.pipeline.StanfordCoreNLP"
-        # include the properties file, so you can change defaults
-        # but any changes in output format will break parse_parser_results()
-        props = "-props default.properties"
-
-        # add and check classpaths
-        jars = [corenlp_path + jar for jar in jars]
-        for jar in jars:
-            if not os.path.exists(jar):
-                logger.error("Error! Cannot locate %s" % jar)
-                sys.exit(1)
+        start_corenlp = corenlp_command(corenlp_path, profile)
+        props_file = PROFILES[profile][0]
+        self.metrics = metrics
+        self.timeouts = timeouts if timeouts is not None else LatencyModel()
 
         # spawn the server
-        start_corenlp = "%s -Xmx1800m -cp %s %s %s" % (java_path, ':'.join(jars), classname, props)
         if VERBOSE:
-            logger.debug(start_corenlp)
-        self.corenlp = pexpect.spawn(start_corenlp)
+            logger.debug(" ".join(start_corenlp))
+        self.corenlp = pexpect.spawn(start_corenlp[0], start_corenlp[1:])
+        # pexpect sleeps 50ms before every send by default
+        self.corenlp.delaybeforesend = 0
 
-        # show progress bar while loading the models
+        # show progress bar while loading the models. The number of models
+        # is only an estimate; we are ready as soon as the shell starts
+        n_models = sum(MODEL_LOADS.get(a, 0) for a in read_annotators(props_file))
         widgets = ['Loading Models: ', Fraction()]
-        pbar = ProgressBar(widgets=widgets, maxval=5, force_update=True).start()
-        self.corenlp.expect("done.", timeout=20) # Load pos tagger model (~5sec)
-        pbar.update(1)
-        self.corenlp.expect("done.", timeout=200) # Load NER-all classifier (~33sec)
-        pbar.update(2)
-        self.corenlp.expect("done.", timeout=600) # Load NER-muc classifier (~60sec)
-        pbar.update(3)
-        self.corenlp.expect("done.", timeout=600) # Load CoNLL classifier (~50sec)
-        pbar.update(4)
-        self.corenlp.expect("done.", timeout=200) # Loading PCFG (~3sec)
-        pbar.update(5)
-        self.corenlp.expect("Entering interactive shell.")
+        pbar = ProgressBar(widgets=widgets, maxval=max(n_models, 1), force_update=True).start()
+        loaded = 0
+        # a single NER classifier can take up to a minute to load
+        while self.corenlp.expect(["done.", "Entering interactive shell."], timeout=600) == 0:
+            loaded += 1
+            pbar.update(min(loaded, n_models))
+        # consume the first prompt, so that every response ends exactly at
+        # the prompt that follows it
+        self.corenlp.expect_exact(PROMPT)
+        self.synced = True
         pbar.finish()
 
-    def _parse(self, text):
+    def _end_time(self, text, deadline=None):
+        """
+        Returns the time by which parsing text has to be finished: what the
+        latency model allows for it, but no later than `deadline` seconds
+        after the request arrived (see jsonrpc.request_received()).
+        """
+        end_time = time.time() + self.timeouts.timeout(text)
+        if deadline is not None:
+            end_time = min(end_time, jsonrpc.request_received() + deadline)
+        return end_time
+
+    def _parse(self, text, parsetree=True, coref=True, deadline=None):
         """
         This is the core interaction with the parser.
 
         It returns a Python data-structure, while the parse()
-        function returns a JSON object
+        function returns a JSON object. Pass parsetree=False or
+        coref=False to leave those sections out of the result.
+
+        `deadline` is the number of seconds the client waits for the
+        response, counted from when the request arrived. Requests whose
+        deadline has passed are not sent to CoreNLP.
+
+        Texts too long for a single line of the shell are parsed in pieces
+        (see split_lines()); coreference is then only resolved within each
+        piece.
         """
-        # clean up anything leftover
-        while True:
-            try:
-                self.corenlp.read_nonblocking (4000, 0.3)
-            except pexpect.TIMEOUT:
-                break
+        end_time = self._end_time(text, deadline)
+        if end_time <= time.time():
+            return {'error': CANCELLED}
 
-        self.corenlp.sendline(text)
+        results = None
+        for line in split_lines(text):
+            more = self._parse_line(line, parsetree, coref, end_time)
+            if 'error' in more:
+                return more
+            results = more if results is None else merge_results(results, more)
+        return results
 
-        # How much time should we give the parser to parse it?
-        # the idea here is that you increase the timeout as a
-        # function of the text's length.
-        # anything longer than 5 seconds requires that you also
-        # increase timeout=5 in jsonrpc.py
-        max_expected_time = min(40, 3 + len(text) / 20.0)
-        end_time = time.time() + max_expected_time
+    def _parse_line(self, text, parsetree, coref, end_time):
+        """Parses a single line of text, see _parse()."""
+        # a previous request timed out: skip the rest of its output
+        if not self.synced:
+            with tracing.span('corenlp.resync'):
+                synced = self._read_response(end_time) is not None
+            if not synced:
+                if self.metrics is not None:
+                    self.metrics.incr('timeouts')
+                return {'error': "timed out waiting for the previous request"}
 
-        incoming = ""
-        while True:
-            # Time left, read more data
-            try:
-                incoming += self.corenlp.read_nonblocking(2000, 1)
-                if "\nNLP>" in incoming:
-                    break
-                time.sleep(0.0001)
-            except pexpect.TIMEOUT:
-                if end_time - time.time() < 0:
-                    logger.error("Error: Timeout with input '%s'" % (incoming))
-                    return {'error': "timed out after %f seconds" % max_expected_time}
-                else:
-                    continue
-            except pexpect.EOF:
-                break
+        sent = time.time()
+        self.corenlp.sendline(text)
+        self.synced = False
+        incoming = self._read_response(end_time)
+        if incoming is None:
+            logger.error("Error: Timeout with input '%s'" % (text))
+            tracing.add('corenlp.jvm', sent, time.time(), chars=len(text), error='timeout')
+            self.timeouts.observe_timeout(text, time.time() - sent)
+            if self.metrics is not None:
+                self.metrics.incr('timeouts')
+            return {'error': "timed out after %f seconds" % (end_time - sent)}
+        received = time.time()
+        tracing.add('corenlp.jvm', sent, received, chars=len(text))
+        self.timeouts.observe(text, received - sent)
 
         if VERBOSE:
             logger.debug("%s\n%s" % ('='*40, incoming))
         try:
-            results = parse_parser_results(incoming)
+            with tracing.span('corenlp.results'):
+                results = parse_parser_results(incoming, parsetree, coref)
         except Exception, e:
             if VERBOSE:
                 logger.debug(traceback.format_exc())
             raise e
 
+        if self.metrics is not None:
+            self.metrics.observe('jvm_seconds', received - sent)
+            self.metrics.observe('wrapper_seconds', time.time() - received)
         return results
 
-    def parse(self, text):
+    def _read_response(self, end_time):
+        """
+        Reads the shell output up to and including the next prompt, or
+        returns None if end_time passes first. Returns as soon as the
+        prompt has been read; chunks are collected in a list and joined
+        once at the end.
+        """
+        chunks = []
+        tail = ""
+        while True:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                chunk = self.corenlp.read_nonblocking(4096, remaining)
+            except pexpect.TIMEOUT:
+                return None
+            except pexpect.EOF:
+                break
+            chunks.append(chunk)
+            # the prompt may be split across two reads
+            window = tail + chunk
+            if PROMPT in window:
+                self.synced = True
+                break
+            tail = window[-len(PROMPT):]
+        return "".join(chunks)
+
+    def _iter_response_lines(self, end_time):
+        """
+        Like _read_response(), but yields the shell output line by line as
+        it arrives. Raises pexpect.TIMEOUT if end_time passes first.
+        """
+        pending = ""
+        while True:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                raise pexpect.TIMEOUT("timed out waiting for CoreNLP")
+            try:
+                chunk = self.corenlp.read_nonblocking(4096, remaining)
+            except pexpect.EOF:
+                break
+            lines = (pending + chunk).split("\n")
+            pending = lines.pop()
+            # nothing follows the prompt, so it is always the last partial
+            # line; note it before yielding, in case the caller stops early
+            if pending == PROMPT[1:]:
+                self.synced = True
+            for line in lines:
+                yield line
+            if self.synced:
+                return
+        if pending:
+            yield pending
+
+    def parse_stream(self, text, parsetree=True, coref=True):
+        """
+        Streaming version of _parse(): a generator that yields each
+        sentence (in the format of parse_parser_results()) as soon as
+        CoreNLP has printed its dependencies, instead of waiting for the
+        whole document. Coreference sets are not available this way.
+        Raises pexpect.TIMEOUT if CoreNLP takes too long.
+
+        Only callers in the same process benefit: the JSON-RPC methods
+        answer with the result of the whole text.
+        """
+        end_time = self._end_time(text)
+        for line in split_lines(text):
+            if not self.synced:
+                if self._read_response(end_time) is None:
+                    raise pexpect.TIMEOUT("timed out waiting for the previous request")
+
+            self.corenlp.sendline(line)
+            self.synced = False
+            lines = self._iter_response_lines(end_time)
+            for sentence in iter_parser_results(lines, {}, parsetree, coref=False):
+                yield sentence
+
+    def parse(self, text, parsetree=True, coref=True, deadline=None):
         """
         This function takes a text string, sends it to the Stanford parser,
         reads in the result, parses the results and returns a list
         with one dictionary entry for each parsed sentence, in JSON format.
         """
-        response = self._parse(text)
+        return json.dumps(self.annotate(text, parsetree, coref, deadline))
+
+    def annotate(self, text, parsetree=True, coref=True, deadline=None):
+        """Like parse(), but returns the result as a dict instead of JSON."""
+        response = self._parse(text, parsetree, coref, deadline)
         logger.debug("Response: '%s'" % (response))
-        return json.dumps(response)
+        return response
+
+    def is_alive(self):
+        return self.corenlp.isalive()
+
+    def close(self):
+        """Stops the CoreNLP process."""
+        self.corenlp.terminate(force=True)
+
+
+class LatencyModel(object):
+    """
+    Decides how long CoreNLP may take for a text. Keeps the parse time per
+    word of the last `window` requests, and allows `margin` times the
+    `quantile` of that rate for each word of the text, plus `slack`
+    seconds, between `minimum` and `maximum` seconds. Until `min_samples`
+    requests have been seen, a fixed estimate based on the text's length
+    is used.
+    """
+    def __init__(self, window=500, quantile=0.95, margin=3.0, slack=1.0,
+                 minimum=2.0, maximum=40.0, min_samples=20):
+        self.quantile = quantile
+        self.margin = margin
+        self.slack = slack
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self.rates = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def rate(self):
+        """Returns the quantile of the seconds per word, or None if there are too few samples."""
+        with self.lock:
+            if len(self.rates) < self.min_samples:
+                return None
+            rates = sorted(self.rates)
+        return rates[int(self.quantile * (len(rates) - 1))]
+
+    def timeout(self, text):
+        rate = self.rate()
+        if rate is None:
+            return min(self.maximum, 3 + len(text) / 20.0)
+        words = max(1, len(text.split()))
+        return max(self.minimum, min(self.maximum, self.margin * rate * words + self.slack))
+
+    def observe(self, text, seconds):
+        words = max(1, len(text.split()))
+        with self.lock:
+            self.rates.append(seconds / words)
+
+    def observe_timeout(self, text, seconds):
+        """
+        Records a text CoreNLP had not finished after `seconds`. It took at
+        least that long, and is counted as taking at least as long as the
+        model allows for it, so that after timeouts the model allows more.
+        """
+        self.observe(text, max(seconds, self.timeout(text)))
+
+    def stats(self):
+        with self.lock:
+            samples = len(self.rates)
+        return {'samples': samples, 'seconds_per_word': self.rate()}
+
+
+class SupervisedCoreNLP(object):
+    """
+    Keeps a StanfordCoreNLP process healthy. A background thread parses a
+    canary sentence every `interval` seconds, and a process that has died,
+    or fails the canary, is replaced. With `standby`, a second process is
+    kept loaded so that it can take over immediately instead of traffic
+    waiting for the models to load again.
+
+    `factory` is called (without arguments) to start a new process.
+    """
+    def __init__(self, factory, interval=30, canary="Karel moves north.", standby=True):
+        self.factory = factory
+        self.interval = interval
+        self.canary = canary
+        self.use_standby = standby
+        self.restarts = 0
+        # guards active/standby and serializes access to the active process
+        self.cond = threading.Condition()
+        self.active = factory()
+        self.standby = None
+        if standby:
+            self._spawn()
+        self.check_now = threading.Event()
+        monitor = threading.Thread(target=self._monitor)
+        monitor.daemon = True
+        monitor.start()
+
+    def _spawn(self):
+        """Starts a new process in the background. It becomes the active
+        process if there is none, the standby otherwise."""
+        def start():
+            try:
+                nlp = self.factory()
+            except Exception:
+                logger.error("Could not start CoreNLP:\n%s" % traceback.format_exc())
+                return
+            with self.cond:
+                if self.active is None:
+                    self.active = nlp
+                    self.cond.notify_all()
+                    if self.use_standby and self.standby is None:
+                        self._spawn()
+                else:
+                    self.standby = nlp
+        thread = threading.Thread(target=start)
+        thread.daemon = True
+        thread.start()
+
+    def _replace(self, nlp):
+        """Replaces a failed process. Must be called with self.cond held."""
+        if self.active is not nlp:
+            return
+        logger.error("CoreNLP process failed, restarting it")
+        self.restarts += 1
+        try:
+            nlp.close()
+        except Exception:
+            pass
+        if self.standby is not None and self.standby.is_alive():
+            self.active, self.standby = self.standby, None
+        else:
+            self.active = self.standby = None
+        self._spawn()
+
+    def _monitor(self):
+        while True:
+            self.check_now.wait(self.interval)
+            self.check_now.clear()
+            with self.cond:
+                nlp = self.active
+                if nlp is None:
+                    continue
+                try:
+                    healthy = nlp.is_alive() and 'error' not in nlp._parse(self.canary)
+                except Exception:
+                    healthy = False
+                if not healthy:
+                    self._replace(nlp)
+                elif self.standby is not None and not self.standby.is_alive():
+                    self.standby = None
+                    self._spawn()
+
+    def _parse(self, text, parsetree=True, coref=True, deadline=None):
+        """
+        Parses text with the active process. A process found dead before
+        the request is replaced first; one that dies while parsing is
+        replaced afterwards (the request is not retried, in case it is
+        what killed the process). Timeouts trigger an immediate health
+        check.
+        """
+        with self.cond:
+            while self.active is None or not self.active.is_alive():
+                if self.active is not None:
+                    self._replace(self.active)
+                if deadline is not None and jsonrpc.request_received() + deadline <= time.time():
+                    return {'error': CANCELLED}
+                self.cond.wait(1)
+            nlp = self.active
+            try:
+                response = nlp._parse(text, parsetree, coref, deadline)
+                if nlp.is_alive():
+                    if response.get('error') not in (None, CANCELLED):
+                        self.check_now.set()
+                    return response
+            except Exception:
+                if nlp.is_alive():
+                    raise
+            self._replace(nlp)
+            return {'error': "CoreNLP process died"}
+
+    def parse(self, text, parsetree=True, coref=True, deadline=None):
+        return json.dumps(self.annotate(text, parsetree, coref, deadline))
+
+    def annotate(self, text, parsetree=True, coref=True, deadline=None):
+        response = self._parse(text, parsetree, coref, deadline)
+        logger.debug("Response: '%s'" % (response))
+        return response
+
+
+class StanfordCoreNLPPool(object):
+    """
+    A pool of StanfordCoreNLP workers behind single parse() and annotate()
+    methods.
+    Each call is dispatched to an idle worker; if every worker is busy,
+    the call waits in line until one of them becomes free.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.idle = Queue.Queue()
+        for worker in workers:
+            self.idle.put(worker)
+
+    def parse(self, text, parsetree=True, coref=True, deadline=None):
+        return json.dumps(self.annotate(text, parsetree, coref, deadline))
+
+    def annotate(self, text, parsetree=True, coref=True, deadline=None):
+        with tracing.span('corenlp.wait_worker'):
+            if deadline is None:
+                worker = self.idle.get()
+            else:
+                try:
+                    worker = self.idle.get(timeout=max(0, jsonrpc.request_received() + deadline - time.time()))
+                except Queue.Empty:
+                    return {'error': CANCELLED}
+        try:
+            return worker.annotate(text, parsetree, coref, deadline)
+        finally:
+            self.idle.put(worker)
+
+
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache, bounded both by the number of
+    entries and by the total size of the cached values. Entries older than
+    `ttl` seconds (if given) are dropped instead of returned.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, size, time added)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.ttl is not None and time.time() - entry[2] > self.ttl:
+                self.bytes -= entry[1]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # re-insert to mark it as the most recently used entry
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, time.time())
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                key, (value, size, added) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                    'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+
+def result_size(result):
+    """
+    Estimates the size of a result as JSON, without encoding it: the
+    length of its strings plus the punctuation and attribute names around
+    each word and dependency.
+    """
+    size = 16
+    for sentence in result.get('sentences', ()):
+        size += len(sentence.get('text', '')) + len(sentence.get('parsetree', '')) + 64
+        for word, attrs in sentence['words']:
+            size += len(word or '') + 8
+            for attr, value in attrs.iteritems():
+                size += len(attr) + len(value) + 8
+        for rel, governor, dependent in sentence['dependencies']:
+            size += len(rel) + len(governor[0]) + len(dependent[0]) + 24
+    return size
+
+
+class MeteredParser(object):
+    """
+    Counts the parse() and annotate() calls to a StanfordCoreNLP instance,
+    pool or CachedParser and records their latency and input length in a
+    metrics.Metrics.
+    """
+    def __init__(self, nlp, metrics):
+        self.nlp = nlp
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        metrics.register('in_flight', lambda: self.in_flight)
+
+    def parse(self, text, parsetree=True, coref=True, deadline=None):
+        return json.dumps(self.annotate(text, parsetree, coref, deadline))
+
+    def annotate(self, text, parsetree=True, coref=True, deadline=None):
+        metrics = self.metrics
+        metrics.incr('requests')
+        metrics.observe('input_chars', len(text))
+        with self.lock:
+            self.in_flight += 1
+        start = time.time()
+        try:
+            response = self.nlp.annotate(text, parsetree, coref, deadline)
+        except Exception:
+            metrics.incr('errors')
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            metrics.observe('request_seconds', time.time() - start)
+        if 'error' in response:
+            metrics.incr('errors')
+        return response
+
+
+class CachedParser(object):
+    """
+    Answers repeated parse() and annotate() calls from an LRUCache in front
+    of a StanfordCoreNLP instance or pool. Error responses are not cached.
+    The cached results are shared, and must not be modified.
+    """
+    def __init__(self, nlp, cache):
+        self.nlp = nlp
+        self.cache = cache
+
+    def parse(self, text, parsetree=True, coref=True, deadline=None):
+        return json.dumps(self.annotate(text, parsetree, coref, deadline))
+
+    def annotate(self, text, parsetree=True, coref=True, deadline=None):
+        key = (text, parsetree, coref)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.nlp.annotate(text, parsetree, coref, deadline)
+            if 'error' not in response:
+                self.cache.put(key, response, result_size(response))
+        return response
 
 
 if __name__ == '__main__':
@@ -251,12 +956,90 @@ if __name__ == '__main__':
                       help='Port to serve on (default: 8080)')
     parser.add_option('-H', '--host', default='127.0.0.1',
                       help='Host to serve on (default: 127.0.0.1. Use 0.0.0.0 to make public)')
+    parser.add_option('-w', '--workers', type='int', default=1,
+                      help='Number of CoreNLP processes to parse with in parallel (default: 1)')
+    parser.add_option('-q', '--queue-size', type='int', default=0,
+                      help='Accept any number of connections and queue up to this many requests '
+                           'for the workers, answering "busy" when the queue is full '
+                           '(default: 0, handle one connection per worker thread instead)')
+    parser.add_option('--profile', default='default', choices=sorted(PROFILES.keys()),
+                      help='Annotators to load: "default" (everything, incl. ner and dcoref) '
+                           'or "karel" (only what kjr_parser needs) (default: default)')
+    parser.add_option('--supervise', action='store_true', default=False,
+                      help='Health-check the CoreNLP processes and restart them when they fail')
+    parser.add_option('--health-interval', type='float', default=30,
+                      help='Seconds between health checks with --supervise (default: 30)')
+    parser.add_option('--no-standby', dest='standby', action='store_false', default=True,
+                      help='With --supervise, do not keep a standby process loaded for failover')
+    parser.add_option('--cache-size', type='int', default=10000,
+                      help='Maximum number of responses to cache, 0 to disable the cache (default: 10000)')
+    parser.add_option('--cache-memory', type='int', default=64,
+                      help='Maximum size of the cached responses in MB (default: 64)')
+    parser.add_option('--cache-ttl', type='float', default=None,
+                      help='Seconds after which cached responses expire (default: never)')
+    parser.add_option('--metrics-port', type='int', default=None,
+                      help='Serve the metrics as plain text at http://HOST:PORT/metrics (default: off)')
+    parser.add_option('--max-message', type='int', default=16,
+                      help='Maximum size of a request in MB (default: 16)')
+    parser.add_option('--trace', default=None, metavar='FILE',
+                      help='Record how long each phase of each request takes, and write it to FILE '
+                           'in the Chrome trace format on exit and on the dump_trace method (default: off)')
     options, args = parser.parse_args()
     server = jsonrpc.Server(jsonrpc.JsonRpc20(),
-                            jsonrpc.TransportTcpIp(addr=(options.host, int(options.port))))
+                            jsonrpc.TransportTcpIp(addr=(options.host, int(options.port)),
+                                                   max_message=options.max_message * 1024 * 1024),
+                            batch_workers=options.workers)
+    metrics = Metrics()
+    timeouts = LatencyModel()
+    metrics.register('timeout_model', timeouts.stats)
+
+    def start_worker():
+        def start():
+            return StanfordCoreNLP(profile=options.profile, metrics=metrics, timeouts=timeouts)
+        if options.supervise:
+            return SupervisedCoreNLP(start, options.health_interval, standby=options.standby)
+        return start()
 
-    nlp = StanfordCoreNLP()
+    workers = []
+    for i in range(options.workers):
+        if options.workers > 1:
+            logger.info('Starting CoreNLP worker %d of %d' % (i + 1, options.workers))
+        workers.append(start_worker())
+    nlp = StanfordCoreNLPPool(workers) if options.workers > 1 else workers[0]
+    if options.supervise:
+        metrics.register('restarts', lambda: sum(worker.restarts for worker in workers))
+    if options.cache_size > 0:
+        cache = LRUCache(options.cache_size, options.cache_memory * 1024 * 1024, options.cache_ttl)
+        nlp = CachedParser(nlp, cache)
+        metrics.register('cache', cache.stats)
+    nlp = MeteredParser(nlp, metrics)
+    metrics.register('queue', server.queue_stats)
+    server.register_function(metrics.stats, name='stats')
     server.register_function(nlp.parse)
 
+    def annotate(text, parsetree=True, coref=True, deadline=None, compact=False):
+        """
+        Like parse, but returns the result itself rather than a JSON string
+        of it, in the format of compact.encode() if compact is true.
+        """
+        result = nlp.annotate(text, parsetree, coref, deadline)
+        return encode_compact(result) if compact else result
+    server.register_function(annotate)
+
+    if options.trace is not None:
+        tracer = tracing.enable()
+        atexit.register(tracer.dump, options.trace)
+
+        def dump_trace():
+            """Writes the spans recorded so far to the trace file and returns their number."""
+            return tracer.dump(options.trace)
+        server.register_function(dump_trace)
+
+    if options.metrics_port is not None:
+        serve_http(metrics, options.host, options.metrics_port)
+        logger.info('Serving metrics on http://%s:%s/metrics' % (options.host, options.metrics_port))
     logger.info('Serving on http://%s:%s' % (options.host, options.port))
-    server.serve()
+    if options.queue_size > 0:
+        server.serve_queued(workers=options.workers, max_queue=options.queue_size)
+    else:
+        server.serve(threaded=options.workers > 1)
@@ -98,7 +98,6 @@ Currently, JSON-RPC 2.0(pre) and JSON-RPC 1.0 are implemented
         - 2008-08-31:     1st release
 
 TODO:
-        - server: multithreading rpc-server
         - client: multicall (send several requests)
         - transport: SSL sockets, maybe HTTP, HTTPS
         - types: support for date/time (ISO 8601)
@@ -135,6 +134,8 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE."""
 #import
 
 import sys
+import traceback
+import tracing
 
 try:
     import json
@@ -160,6 +161,7 @@ PROCEDURE_EXCEPTION    = -32000
 AUTHENTIFICATION_ERROR = -32001
 PERMISSION_DENIED      = -32002
 INVALID_PARAM_VALUES   = -32003
+SERVER_BUSY            = -32004
 
 #human-readable messages
 ERROR_MESSAGE = {
@@ -172,7 +174,8 @@ ERROR_MESSAGE = {
     PROCEDURE_EXCEPTION   : "Procedure exception.",
     AUTHENTIFICATION_ERROR : "Authentification error.",
     PERMISSION_DENIED   : "Permission denied.",
-    INVALID_PARAM_VALUES: "Invalid parameter values."
+    INVALID_PARAM_VALUES: "Invalid parameter values.",
+    SERVER_BUSY         : "Server busy."
     }
  
 #----------------------
@@ -186,6 +189,15 @@ class RPCTransportError(RPCError):
     """Transport error."""
 class RPCTimeoutError(RPCTransportError):
     """Transport/reply timeout."""
+class RPCMessageTooLong(RPCTransportError):
+    """Message longer than the max_message of the transport.
+
+    `remaining` is the number of bytes of the message that have not been
+    read, if that is known (framed messages), else None.
+    """
+    def __init__(self, message, remaining=None):
+        RPCTransportError.__init__(self, message)
+        self.remaining = remaining
 
 class RPCFault(RPCError):
     """RPC error/fault package received.
@@ -252,6 +264,10 @@ class RPCInvalidParamValues(RPCFault):
     """INVALID_PARAM_VALUES"""
     def __init__(self, error_data=None):
         RPCFault.__init__(self, INVALID_PARAM_VALUES, ERROR_MESSAGE[INVALID_PARAM_VALUES], error_data)
+class RPCServerBusy(RPCFault):
+    """SERVER_BUSY"""
+    def __init__(self, error_data=None):
+        RPCFault.__init__(self, SERVER_BUSY, ERROR_MESSAGE[SERVER_BUSY], error_data)
 
 
 #=========================================
@@ -439,6 +455,8 @@ class JsonRpc10:
                     raise RPCPermissionDenied(error_data)
                 elif data["error"]["code"] == INVALID_PARAM_VALUES:
                     raise RPCInvalidParamValues(error_data)
+                elif data["error"]["code"] == SERVER_BUSY:
+                    raise RPCServerBusy(error_data)
                 else:
                     raise RPCFault(data["error"]["code"], data["error"]["message"], error_data)
             #other error-format
@@ -544,6 +562,17 @@ class JsonRpc20:
             return '{"jsonrpc": "2.0", "error": {"code":%s, "message": %s, "data": %s}, "id": %s}' % \
                     (self.dumps(error.error_code), self.dumps(error.error_message), self.dumps(error.error_data), self.dumps(id))
 
+    def dumps_batch( self, strings ):
+        """serialize a batch of already serialized requests/notifications/responses
+
+        :Returns:   [..., ...]
+        """
+        return "[%s]" % ", ".join(strings)
+
+    def is_batch( self, string ):
+        """check whether a serialized request/response is a batch (without de-serializing it)"""
+        return string.lstrip()[:1] == "["
+
     def loads_request( self, string ):
         """de-serialize a JSON-RPC Request/Notification
 
@@ -556,6 +585,31 @@ class JsonRpc20:
             data = self.loads(string)
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
+        return self._request_from_data( data )
+
+    def loads_batch_request( self, string ):
+        """de-serialize a batch of JSON-RPC Requests/Notifications
+
+        :Returns:   a list with, for each element of the batch, the result of
+                    loads_request, or the RPCFault it would raise
+        :Raises:    RPCParseError, RPCInvalidRPC if the batch is no array or empty
+        """
+        try:
+            data = self.loads(string)
+        except ValueError, err:
+            raise RPCParseError("No valid JSON. (%s)" % str(err))
+        if not isinstance(data, list) or not data:
+            raise RPCInvalidRPC("Invalid batch, must be a non-empty array.")
+        requests = []
+        for element in data:
+            try:
+                requests.append( self._request_from_data( element ) )
+            except RPCFault, err:
+                requests.append( err )
+        return requests
+
+    def _request_from_data( self, data ):
+        """check a de-serialized request, see loads_request"""
         if not isinstance(data, dict):  raise RPCInvalidRPC("No valid RPC-package.")
         if "jsonrpc" not in data:       raise RPCInvalidRPC("""Invalid Response, "jsonrpc" missing.""")
         if not isinstance(data["jsonrpc"], (str, unicode)):
@@ -592,6 +646,37 @@ class JsonRpc20:
             data = self.loads(string)
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
+        return self._response_from_data( data )
+
+    def loads_batch_response( self, string ):
+        """de-serialize a batch of JSON-RPC Responses/errors
+
+        :Returns: | a dict id -> result, or the RPCFault for errors
+                  | (errors without id, e.g. for invalid requests, are left out)
+        :Raises:  | RPCFault for a single error-response instead of a batch
+                    (e.g. if the whole batch was invalid), RPCParseError, RPCInvalidRPC
+        """
+        try:
+            data = self.loads(string)
+        except ValueError, err:
+            raise RPCParseError("No valid JSON. (%s)" % str(err))
+        if isinstance(data, dict):
+            self._response_from_data( data )
+            raise RPCInvalidRPC("Invalid Response, expected a batch.")
+        if not isinstance(data, list):  raise RPCInvalidRPC("No valid RPC-package.")
+        results = {}
+        for element in data:
+            try:
+                result, id = self._response_from_data( element )
+            except RPCFault, err:
+                if not isinstance(element, dict) or element.get("id") is None:
+                    continue
+                result, id = err, element["id"]
+            results[id] = result
+        return results
+
+    def _response_from_data( self, data ):
+        """check a de-serialized response, see loads_response"""
         if not isinstance(data, dict):  raise RPCInvalidRPC("No valid RPC-package.")
         if "jsonrpc" not in data:       raise RPCInvalidRPC("""Invalid Response, "jsonrpc" missing.""")
         if not isinstance(data["jsonrpc"], (str, unicode)):
@@ -632,6 +717,8 @@ class JsonRpc20:
                 raise RPCPermissionDenied(error_data)
             elif data["error"]["code"] == INVALID_PARAM_VALUES:
                 raise RPCInvalidParamValues(error_data)
+            elif data["error"]["code"] == SERVER_BUSY:
+                raise RPCServerBusy(error_data)
             else:
                 raise RPCFault(data["error"]["code"], data["error"]["message"], error_data)
         #result
@@ -654,6 +741,9 @@ def log_dummy( message ):
 def log_stdout( message ):
     """print message to STDOUT"""
     print message
+def log_stderr( message ):
+    """print message to STDERR"""
+    print >>sys.stderr, message
 
 def log_file( filename ):
     """return a logfunc which logs to a file (in utf-8)"""
@@ -733,9 +823,89 @@ class TransportSTDINOUT(Transport):
         return sys.stdin.read()
 
 
-import socket, select
+import os, re, socket, select, threading, Queue, heapq
+
+#: information about the request handled by the current thread of a
+#: socket-server: `received` is the time (time.time()) the request arrived,
+#: before it waited for a worker
+request_context = threading.local()
+
+def request_received():
+    """return the time the current request arrived, or now outside of a server"""
+    received = getattr(request_context, 'received', None)
+    if received is None:
+        return time.time()
+    return received
+
+#: default maximum size of a received message in bytes
+MAX_MESSAGE = 16 * 1024 * 1024
+
+def netstring( string ):
+    """frame a message as netstring: "<length>:<data>," """
+    return "%d:%s," % (len(string), string)
+
+class JsonEnd:
+    """find the end of a JSON-array or -object received in chunks
+
+    Keeps track of the nesting depth of arrays and objects outside of
+    strings, so that every byte is only looked at once, and the message
+    does not have to be decoded to find out whether it is complete.
+    """
+    BRACKET = re.compile( r'[][{}"]' )
+    # the end of a string, or an escaped character (or a backslash at the end of a chunk)
+    STRING = re.compile( r'"|\\.?', re.DOTALL )
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False    #the last chunk ended with a backslash in a string
+    def feed( self, chunk ):
+        """return True if chunk completes the outermost array or object"""
+        pos = 0
+        if self.escaped:
+            self.escaped = False
+            pos = 1
+        while 1:
+            if self.in_string:
+                match = self.STRING.search( chunk, pos )
+                if match is None:
+                    return False
+                if match.group() == '"':
+                    self.in_string = False
+                elif match.group() == "\\":
+                    self.escaped = True
+            else:
+                match = self.BRACKET.search( chunk, pos )
+                if match is None:
+                    return False
+                token = match.group()
+                if token == '"':
+                    self.in_string = True
+                elif token in "[{":
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth <= 0:
+                        return True
+            pos = match.end()
+
 class TransportSocket(Transport):
     """Transport via socket.
+
+    By default, every call uses a new connection; a request ends when it is
+    complete JSON, a response when the server closes the connection. With
+    `keepalive`, the client keeps its connection open and frames every
+    message as netstring (see netstring()), so that the next call does not
+    need a new connection. Servers accept both kinds of clients: a
+    connection whose first byte is a digit is treated as keep-alive. Every
+    framed request is answered with a frame, so that the client never
+    waits for nothing; requests without a response (notifications, or
+    batches of them) get an empty one.
+    Messages may be of any size up to `max_message` bytes; longer ones are
+    refused, and the connection is closed: clients raise RPCMessageTooLong,
+    servers first answer with an error saying so (see Server.refuse). Servers
+    give up on a connection (and close it) if sending or receiving a
+    message stalls for `timeout` seconds; idle keep-alive connections may
+    wait for their next request as long as they like.
    
     :SeeAlso:   python-module socket
     :TODO:
@@ -743,21 +913,30 @@ class TransportSocket(Transport):
         - improve this (e.g. make sure that connections are closed, socket-files are deleted etc.)
         - exception-handling? (socket.error)
     """
-    def __init__( self, addr, limit=4096, sock_type=socket.AF_INET, sock_prot=socket.SOCK_STREAM, timeout=5.0, logfunc=log_dummy ):
+    def __init__( self, addr, limit=4096, sock_type=socket.AF_INET, sock_prot=socket.SOCK_STREAM, timeout=5.0, logfunc=log_dummy, keepalive=False, max_message=MAX_MESSAGE ):
         """
         :Parameters:
             - addr: socket-address
+            - limit: number of bytes to read at once
             - timeout: timeout in seconds
             - logfunc: function for logging, logfunc(message)
+            - keepalive: reuse the connection for all calls (client only)
+            - max_message: maximum size of a received message in bytes,
+              i.e. of the requests of a server, or the responses of a client
         :Raises: socket.timeout after timeout
         """
+        self.keepalive = keepalive
         self.limit  = limit
+        self.max_message = max_message
         self.addr   = addr
         self.s_type = sock_type
         self.s_prot = sock_prot
         self.s      = None
         self.timeout = timeout
         self.log    = logfunc
+        self.queue  = None      #request queue of serve_queued
+        self.rejected = 0       #number of requests answered with busy()
+        self.refuse = None      #function returning the response to a request that is too long
     def connect( self ):
         self.close()
         self.log( "connect to %s" % repr(self.addr) )
@@ -778,53 +957,400 @@ class TransportSocket(Transport):
         self.log( "--> "+repr(string) )
         self.s.sendall( string )
     def recv( self ):
+        """receive until the server closes the connection"""
         if self.s is None:
             self.connect()
-        data = self.s.recv( self.limit )
-        while( select.select((self.s,), (), (), 0.1)[0] ):  #TODO: this select is probably not necessary, because server closes this socket
-            d = self.s.recv( self.limit )
-            if len(d) == 0:
+        chunks = []
+        size = 0
+        while 1:
+            chunk = self.s.recv( self.limit )
+            if not chunk:
                 break
-            data += d
+            size += len(chunk)
+            if size > self.max_message:
+                self._too_long( size, complete=False )
+            chunks.append( chunk )
+        data = "".join(chunks)
         self.log( "<-- "+repr(data) )
         return data
+    def _too_long( self, size, complete=True, remaining=None ):
+        """refuse a message of size bytes (or more, if it is not `complete`)
+
+        :Raises: RPCMessageTooLong
+        """
+        error = "message of %s%d bytes is longer than max_message (%d bytes)" % (
+                "" if complete else "at least ", size, self.max_message)
+        self.log( error )
+        raise RPCMessageTooLong(error, remaining)
 
     def sendrecv( self, string ):
-        """send data + receive data + close"""
+        """send data + receive data + close
+
+        With keepalive, the connection is kept open instead. If a kept
+        connection turns out to have been closed by the server, the call
+        is repeated once on a new connection.
+        """
+        if not self.keepalive:
+            try:
+                self.send( string )
+                return self.recv()
+            finally:
+                self.close()
+        for attempt in (1, 2):
+            reused = self.s is not None
+            try:
+                self.send( netstring(string) )
+                data = self._recv_frame( self.s )
+            except (socket.timeout, RPCTransportError):
+                self.close()
+                raise
+            except socket.error:
+                self.close()
+                if reused and attempt == 1:
+                    continue
+                raise
+            if data is None:
+                self.close()
+                if reused and attempt == 1:
+                    continue
+                raise RPCTransportError("connection closed by %s" % repr(self.addr))
+            self.log( "<-- "+repr(data) )
+            return data
+
+    def _recv_exactly( self, conn, size ):
+        """receive exactly size bytes"""
+        chunks = []
+        while size > 0:
+            chunk = conn.recv( min(size, 65536) )
+            if not chunk:
+                raise RPCTransportError("connection closed in the middle of a message")
+            chunks.append( chunk )
+            size -= len(chunk)
+        return "".join(chunks)
+    def _recv_frame( self, conn ):
+        """receive one netstring-framed message.
+
+        :Returns: the message, or None if the connection was closed before it
+        :Raises: RPCTransportError if the frame is malformed or cut short
+        """
+        # the length is usually in the first packet: peek at it, then
+        # consume exactly the header, so that nothing needs to be buffered
+        header = conn.recv( 16, socket.MSG_PEEK )
+        if not header:
+            return None
+        end = header.find(":")
+        if end >= 0:
+            header = self._recv_exactly( conn, end+1 )[:-1]
+        else:
+            header = ""
+            while 1:
+                c = self._recv_exactly( conn, 1 )
+                if c == ":":
+                    break
+                header += c
+                if len(header) > 15:
+                    break
+        if not header.isdigit():
+            raise RPCTransportError("invalid message length: %s" % repr(header[:16]))
+        if int(header) > self.max_message:
+            self._too_long( int(header), remaining=int(header)+1 )
+        data = self._recv_exactly( conn, int(header)+1 )
+        if data[-1] != ",":
+            raise RPCTransportError("message does not end with ','")
+        return data[:-1]
+    def _recv_message( self, conn ):
+        """receive one message without framing.
+
+        Such clients do not say how long their message is, so it is read
+        until the client shuts down its side of the connection, or until
+        the outermost array or object of the JSON-document is closed (see
+        JsonEnd); whether it is valid JSON is up to the handler.
+
+        :Raises: RPCTransportError if the message is longer than max_message
+        """
+        chunks = []
+        size = 0
+        end = JsonEnd()
+        while 1:
+            chunk = conn.recv( self.limit )
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > self.max_message:
+                self._too_long( size, complete=False )
+            chunks.append( chunk )
+            if end.feed( chunk ):
+                break
+        return "".join(chunks)
+    def _is_framed( self, conn ):
+        """check whether the client on conn uses netstring-framing"""
+        return conn.recv( 1, socket.MSG_PEEK ).isdigit()
+    def _accept( self ):
+        """accept a connection, on which sending and receiving time out after self.timeout"""
+        conn, addr = self.s.accept()
+        conn.settimeout( self.timeout )
+        return conn, addr
+    def serve(self, handler, n=None, threaded=False):
+        """open socket, wait for incoming connections and handle them.
+
+        Without `threaded`, requests are handled one at a time, in the order
+        they arrive: the connections wait (with select) until they send a
+        request, so that an idle keep-alive connection does not keep the
+        others from being served.
+
+        :Parameters:
+            - n: serve n requests, None=forever
+            - threaded: handle each connection in its own thread, so that
+              one slow request does not block the others
+        """
+        self.close()
+        self.s = socket.socket( self.s_type, self.s_prot )
+        waiting = {}    #connection -> address, for connections without a request yet
         try:
-            self.send( string )
-            return self.recv()
+            self.log( "listen %s" % repr(self.addr) )
+            self.s.bind( self.addr )
+            self.s.listen( socket.SOMAXCONN )
+            n_current = 0
+            while 1:
+                if n is not None  and  n_current >= n:
+                    break
+                if threaded:
+                    conn, addr = self._accept()
+                    t = threading.Thread( target=self._handle_connection, args=(conn, addr, handler) )
+                    t.daemon = True
+                    t.start()
+                    n_current += 1
+                    continue
+                for sock in select.select( [self.s] + waiting.keys(), [], [] )[0]:
+                    if sock is self.s:
+                        conn, addr = self._accept()
+                        waiting[conn] = addr
+                        continue
+                    addr = waiting.pop(sock)
+                    self._handle_connection( sock, addr, handler, keep=waiting.__setitem__ )
+                    n_current += 1
         finally:
+            for conn in waiting:
+                conn.close()
             self.close()
-    def serve(self, handler, n=None):
-        """open socket, wait for incoming connections and handle them.
-        
+    def serve_queued(self, handler, busy, n=None, workers=1, max_queue=16):
+        """open socket and handle incoming connections with a pool of threads.
+
+        A single thread accepts connections and waits (with select) until
+        they have sent their request, so that any number of clients can
+        connect at once. Connections with a pending request are put on a
+        queue, from which `workers` threads handle them. If the queue is
+        full, the request is answered with busy(data) instead.
+
         :Parameters:
+            - busy: function returning the response for a rejected request
             - n: serve n requests, None=forever
+            - workers: number of threads calling handler
+            - max_queue: number of requests that may wait for a worker
         """
         self.close()
         self.s = socket.socket( self.s_type, self.s_prot )
+        self.queue = Queue.Queue( max_queue )
+        # keep-alive connections come back from the workers after each
+        # request; a byte on the wakeup-pipe interrupts select for them
+        self._returned = Queue.Queue()
+        self._wakeup = os.pipe()
+        for i in range(workers):
+            t = threading.Thread( target=self._work, args=(handler,) )
+            t.daemon = True
+            t.start()
         try:
             self.log( "listen %s" % repr(self.addr) )
             self.s.bind( self.addr )
-            self.s.listen(1)
+            self.s.listen( socket.SOMAXCONN )
+            waiting = {}    #connection -> address, for connections without a request yet
             n_current = 0
             while 1:
                 if n is not None  and  n_current >= n:
                     break
-                conn, addr = self.s.accept()
-                self.log( "%s connected" % repr(addr) )
-                data = conn.recv(self.limit)
-                self.log( "%s --> %s" % (repr(addr), repr(data)) )
-                result = handler(data)
-                if data is not None:
+                readable = select.select( [self.s, self._wakeup[0]] + waiting.keys(), [], [] )[0]
+                for sock in readable:
+                    if sock is self.s:
+                        conn, addr = self._accept()
+                        waiting[conn] = addr
+                        continue
+                    if sock is self._wakeup[0]:
+                        os.read( self._wakeup[0], 4096 )
+                        while not self._returned.empty():
+                            conn, addr = self._returned.get()
+                            waiting[conn] = addr
+                        continue
+                    addr = waiting.pop(sock)
+                    try:
+                        if not sock.recv( 1, socket.MSG_PEEK ):
+                            self.log( "%s close" % repr(addr) )
+                            sock.close()
+                            continue
+                    except socket.error, err:
+                        self.log( "%s error: %s" % (repr(addr), err) )
+                        sock.close()
+                        continue
+                    try:
+                        self.queue.put_nowait( (sock, addr, time.time()) )
+                    except Queue.Full:
+                        if self._reject( sock, addr, busy ):
+                            waiting[sock] = addr
+                    n_current += 1
+        finally:
+            for fd in self._wakeup:
+                os.close( fd )
+            self.close()
+    def queue_stats(self):
+        """return the number of queued and rejected requests of serve_queued"""
+        if self.queue is None:
+            return {'depth': 0, 'max': 0, 'rejected': self.rejected}
+        return {'depth': self.queue.qsize(), 'max': self.queue.maxsize, 'rejected': self.rejected}
+    def _work(self, handler):
+        """worker thread for serve_queued"""
+        while 1:
+            conn, addr, received = self.queue.get()
+            try:
+                self._handle_connection( conn, addr, handler, received, keep=self._keep )
+            except Exception, err:
+                self.log( "%s error: %s" % (repr(addr), err) )
+    def _keep(self, conn, addr):
+        """hand a keep-alive connection back to serve_queued, to wait for its next request"""
+        self._returned.put( (conn, addr) )
+        os.write( self._wakeup[1], "x" )
+    def _reject(self, conn, addr, busy):
+        """answer a request that does not fit into the queue
+
+        :Returns: True if the connection is kept open (keep-alive)
+        """
+        self.rejected += 1
+        try:
+            framed = self._is_framed( conn )
+            if framed:
+                data = self._recv_frame( conn )
+            else:
+                data = self._recv_message( conn )
+            self.log( "%s --> %s (busy)" % (repr(addr), repr(data)) )
+            result = busy(data)
+            if framed:
+                self.log( "%s <-- %s" % (repr(addr), repr(result)) )
+                conn.sendall( netstring(result or "") )
+                return True
+            if result is not None:
+                self.log( "%s <-- %s" % (repr(addr), repr(result)) )
+                conn.sendall( result )
+        except (socket.error, RPCTransportError), err:
+            self.log( "%s error: %s" % (repr(addr), err) )
+        conn.close()
+        return False
+    def _trace(self, queued, start, read, handled):
+        """record the spans of a request handled by _handle_connection
+
+        They are recorded after the handler has set the request id: the
+        time the request waited in the queue of serve_queued (if `queued`
+        is given), the time to receive it, to handle it and to send the
+        response.
+        """
+        if tracing.tracer is None:
+            return
+        if queued is not None:
+            tracing.add( "server.queue", queued, start )
+        tracing.add( "server.recv", start, read )
+        tracing.add( "server.handle", read, handled )
+        tracing.add( "server.send", handled, time.time() )
+    def _send_refusal(self, conn, framed, error):
+        """answer a request that is too long (RPCMessageTooLong `error`) with
+        refuse(), before the connection is closed
+
+        The rest of the request is read (and dropped) for up to `timeout`
+        seconds, so that the client gets to read the answer, instead of
+        finding the connection reset while it is still sending. The rest of
+        a frame is known to end after error.remaining bytes; unframed
+        clients close the connection once they have read the answer.
+        """
+        response = self.refuse( str(error) )
+        end_time = time.time() + self.timeout
+        try:
+            if framed:
+                remaining = error.remaining
+                while remaining > 0 and time.time() < end_time:
+                    chunk = conn.recv( min(remaining, 65536) )
+                    if not chunk:
+                        return
+                    remaining -= len(chunk)
+                if remaining <= 0:
+                    conn.sendall( netstring(response) )
+                return
+            conn.sendall( response )
+            conn.shutdown( socket.SHUT_WR )
+            while time.time() < end_time and conn.recv( 65536 ):
+                pass
+        except socket.error, err:
+            self.log( "error while refusing a request: %s" % err )
+    def _handle_connection(self, conn, addr, handler, received=None, keep=None):
+        """receive one request on an accepted connection, send back the result and close it.
+
+        Keep-alive connections are not closed: their requests are handled
+        until the client closes the connection, or, if `keep` is given,
+        keep(conn, addr) is called after the first one. Connections that the
+        client closed before sending a request are closed.
+
+        The time the request arrived (`received`, default: when it is read)
+        is available to the handler as request_context.received.
+        """
+        framed = False
+        try:
+            self.log( "%s connected" % repr(addr) )
+            first = conn.recv( 1, socket.MSG_PEEK )
+            if not first:
+                return
+            framed = first.isdigit()
+            if framed:
+                while 1:
+                    # wait for the next request (without timeout) before timing its reception
+                    select.select( [conn], [], [] )
+                    if not conn.recv( 1, socket.MSG_PEEK ):
+                        break
+                    start = time.time()
+                    data = self._recv_frame( conn )
+                    if data is None:
+                        break
+                    read = time.time()
+                    request_context.received = received if received is not None else read
+                    self.log( "%s --> %s" % (repr(addr), repr(data)) )
+                    result = handler(data)
+                    handled = time.time()
                     self.log( "%s <-- %s" % (repr(addr), repr(result)) )
-                    conn.send( result )
+                    conn.sendall( netstring(result or "") )
+                    self._trace( received, start, read, handled )
+                    received = None
+                    if keep is not None:
+                        keep( conn, addr )
+                        conn = None
+                        break
+                return
+            start = time.time()
+            data = self._recv_message( conn )
+            read = time.time()
+            request_context.received = received if received is not None else read
+            self.log( "%s --> %s" % (repr(addr), repr(data)) )
+            result = handler(data)
+            handled = time.time()
+            if result is not None:
+                self.log( "%s <-- %s" % (repr(addr), repr(result)) )
+                conn.sendall( result )
+            self._trace( received, start, read, handled )
+        except RPCMessageTooLong, err:
+            self.log( "%s error: %s" % (repr(addr), err) )
+            if self.refuse is not None:
+                self._send_refusal( conn, framed, err )
+        except (socket.error, RPCTransportError), err:
+            self.log( "%s error: %s" % (repr(addr), err) )
+        finally:
+            request_context.received = None
+            tracing.set_request_id( None )
+            if conn is not None:
                 self.log( "%s close" % repr(addr) )
                 conn.close()
-                n_current += 1
-        finally:
-            self.close()
 
 
 if hasattr(socket, 'AF_UNIX'):
@@ -832,7 +1358,7 @@ if hasattr(socket, 'AF_UNIX'):
     class TransportUnixSocket(TransportSocket):
         """Transport via Unix Domain Socket.
         """
-        def __init__(self, addr=None, limit=4096, timeout=5.0, logfunc=log_dummy):
+        def __init__(self, addr=None, limit=4096, timeout=5.0, logfunc=log_dummy, keepalive=False, max_message=MAX_MESSAGE):
             """
             :Parameters:
                 - addr: "socket_file"
@@ -841,18 +1367,117 @@ if hasattr(socket, 'AF_UNIX'):
                      and no socket-file is created.
             :SeeAlso:   TransportSocket
             """
-            TransportSocket.__init__( self, addr, limit, socket.AF_UNIX, socket.SOCK_STREAM, timeout, logfunc )
+            TransportSocket.__init__( self, addr, limit, socket.AF_UNIX, socket.SOCK_STREAM, timeout, logfunc, keepalive, max_message )
 
 class TransportTcpIp(TransportSocket):
     """Transport via TCP/IP.
     """
-    def __init__(self, addr=None, limit=4096, timeout=5.0, logfunc=log_dummy):
+    def __init__(self, addr=None, limit=4096, timeout=5.0, logfunc=log_dummy, keepalive=False, max_message=MAX_MESSAGE):
         """
         :Parameters:
             - addr: ("host",port)
         :SeeAlso:   TransportSocket
         """
-        TransportSocket.__init__( self, addr, limit, socket.AF_INET, socket.SOCK_STREAM, timeout, logfunc )
+        TransportSocket.__init__( self, addr, limit, socket.AF_INET, socket.SOCK_STREAM, timeout, logfunc, keepalive, max_message )
+
+class TransportPool(Transport):
+    """Thread-safe pool of client connections.
+
+    A single socket-transport can only be used by one thread at a time.
+    A TransportPool gives every call a transport of its own: an idle one
+    from the pool, or, up to `max_size`, a new one from factory(). If all
+    are in use, the call waits (at most `wait_timeout` seconds, if given)
+    until one is returned. Transports that have been idle for more than
+    `idle_timeout` seconds are closed, and so are transports on which a
+    call failed.
+
+    :Example:
+        >>> pool = TransportPool( lambda: TransportTcpIp(addr=("127.0.0.1",31415), keepalive=True), max_size=4 )
+        >>> proxy = ServerProxy( JsonRpc20(), pool )
+    """
+    def __init__( self, factory, max_size=4, idle_timeout=60.0, wait_timeout=None, logfunc=log_dummy ):
+        """
+        :Parameters:
+            - factory: function returning a new (keep-alive) transport
+            - max_size: maximum number of transports
+            - idle_timeout: seconds after which idle transports are closed
+            - wait_timeout: seconds to wait for a transport, None=forever
+            - logfunc: function for logging, logfunc(message)
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.log = logfunc
+        self.idle = []          #(transport, time returned), most recently used last
+        self.size = 0           #number of open transports, idle or in use
+        self.cond = threading.Condition()
+    def __repr__(self):
+        return "<TransportPool, %d/%d transports, %d idle>" % (self.size, self.max_size, len(self.idle))
+
+    def _evict( self ):
+        """close transports that have been idle for too long (holding self.cond)"""
+        limit = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < limit:
+            transport = self.idle.pop(0)[0]
+            self.log( "evict idle %s" % repr(transport) )
+            transport.close()
+            self.size -= 1
+    def acquire( self ):
+        """take a transport from the pool, creating one if there is room
+
+        :Raises: RPCTransportError if none is available within wait_timeout
+        """
+        end_time = None if self.wait_timeout is None else time.time() + self.wait_timeout
+        with self.cond:
+            while 1:
+                self._evict()
+                if self.idle:
+                    return self.idle.pop()[0]
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                if end_time is None:
+                    self.cond.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise RPCTransportError("no connection available after %s seconds" % self.wait_timeout)
+                    self.cond.wait( remaining )
+        try:
+            return self.factory()
+        except:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+    def release( self, transport, broken=False ):
+        """return a transport to the pool; broken transports are closed instead"""
+        with self.cond:
+            if broken:
+                transport.close()
+                self.size -= 1
+            else:
+                self.idle.append( (transport, time.time()) )
+            self.cond.notify()
+    def close( self ):
+        """close all idle transports"""
+        with self.cond:
+            for transport, returned in self.idle:
+                transport.close()
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def sendrecv( self, string ):
+        """send data + receive data, on a transport of the pool"""
+        transport = self.acquire()
+        try:
+            data = transport.sendrecv( string )
+        except:
+            self.release( transport, broken=True )
+            raise
+        self.release( transport )
+        return data
 
 
 #=========================================
@@ -896,15 +1521,23 @@ class ServerProxy:
         # JSON-RPC 2.0: only args OR kwargs allowed!
         if len(args) > 0 and len(kwargs) > 0:
             raise ValueError("Only positional or named parameters are allowed!")
-        if len(kwargs) == 0:
-            req_str  = self.__data_serializer.dumps_request( methodname, args, id )
-        else:
-            req_str  = self.__data_serializer.dumps_request( methodname, kwargs, id )
-        try:
-            resp_str = self.__transport.sendrecv( req_str )
-        except Exception,err:
-            raise RPCTransportError(err)
-        resp = self.__data_serializer.loads_response( resp_str )
+        # while tracing, the id identifies the request in the server's spans
+        request_id = tracing.new_request_id()
+        if request_id is not None:
+            id = request_id
+        with tracing.request( request_id ), tracing.span( "client.call", method=methodname ):
+            with tracing.span( "client.serialize" ):
+                if len(kwargs) == 0:
+                    req_str  = self.__data_serializer.dumps_request( methodname, args, id )
+                else:
+                    req_str  = self.__data_serializer.dumps_request( methodname, kwargs, id )
+            with tracing.span( "client.sendrecv" ):
+                try:
+                    resp_str = self.__transport.sendrecv( req_str )
+                except Exception,err:
+                    raise RPCTransportError(err)
+            with tracing.span( "client.deserialize" ):
+                resp = self.__data_serializer.loads_response( resp_str )
         return resp[0]
 
     def __getattr__(self, name):
@@ -913,6 +1546,311 @@ class ServerProxy:
         #  result getattr(my_server_proxy, "strange-python-name")(args)
         return _method(self.__req, name)
 
+    def _batch( self ):
+        """collect calls and send them as one JSON-RPC 2.0 batch.
+
+        Calls on the returned Batch return BatchCall placeholders; the batch
+        is sent when the with-block ends, after which their result() is
+        available::
+
+            with proxy._batch() as batch:
+                calls = [batch.parse(text=t) for t in texts]
+            results = [call.result() for call in calls]
+
+        :Returns: a Batch, to be used as context manager
+        """
+        return Batch( self.__data_serializer, self.__transport )
+
+class BatchCall:
+    """placeholder for the result of a call in a Batch"""
+    def __init__(self, method):
+        self.method = method
+        self._done = False
+        self._result = None
+        self._error = None
+    def __repr__(self):
+        return "<BatchCall %s, %s>" % (self.method, "done" if self._done else "pending")
+    def done(self):
+        """return True once the batch has been sent and the result is known"""
+        return self._done
+    def result(self):
+        """return the result of the call
+
+        :Raises: the RPCFault/RPCTransportError of the call, or RPCError if
+                 the batch has not been sent yet
+        """
+        if not self._done:
+            raise RPCError("the batch has not been sent yet")
+        if self._error is not None:
+            raise self._error
+        return self._result
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done = True
+
+class Batch:
+    """calls collected by ServerProxy._batch(), sent as one JSON-RPC 2.0 batch
+
+    The calls get the ids 0, 1, 2, ...; the responses are matched to them
+    by id, so the server may answer in any order.
+    """
+    def __init__( self, data_serializer, transport ):
+        if not hasattr(data_serializer, "loads_batch_response"):
+            raise ValueError("Batches are only supported by JSON-RPC 2.0")
+        self.__data_serializer = data_serializer
+        self.__transport = transport
+        self.requests = []
+        self.calls = []
+        self.ids = []
+    def __enter__( self ):
+        return self
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type is None:
+            self.send()
+        return False
+    def __req( self, methodname, args=None, kwargs=None ):
+        if len(args) > 0 and len(kwargs) > 0:
+            raise ValueError("Only positional or named parameters are allowed!")
+        id = len(self.calls)
+        request_id = tracing.new_request_id()
+        if request_id is not None:
+            id = request_id
+        self.requests.append( self.__data_serializer.dumps_request( methodname, kwargs or args, id ) )
+        call = BatchCall( methodname )
+        self.calls.append( call )
+        self.ids.append( id )
+        return call
+    def send( self ):
+        """send the collected calls and fill in their results"""
+        if not self.calls:
+            return
+        requests, calls, ids = self.requests, self.calls, self.ids
+        self.requests, self.calls, self.ids = [], [], []
+        try:
+            with tracing.span( "client.batch", calls=len(calls) ):
+                resp_str = self.__transport.sendrecv( self.__data_serializer.dumps_batch( requests ) )
+                results = self.__data_serializer.loads_batch_response( resp_str )
+        except RPCFault, err:
+            for call in calls:
+                call._set( error=err )
+            return
+        except Exception, err:
+            for call in calls:
+                call._set( error=RPCTransportError(err) )
+            return
+        for id, call in zip(ids, calls):
+            if id not in results:
+                call._set( error=RPCInvalidRPC("Invalid Response, no response for id %s." % id) )
+            elif isinstance(results[id], RPCFault):
+                call._set( error=results[id] )
+            else:
+                call._set( result=results[id] )
+    def __getattr__( self, name ):
+        return _method(self.__req, name)
+
+class Future:
+    """result of a call of AsyncServerProxy, which becomes available later
+
+    Callers may also create and finish Futures of their own, e.g. for work
+    that continues when a call is done. An exception raised by a callback
+    is logged with `logfunc`, and does not keep the other callbacks (or
+    the thread that finished the call) from running.
+    """
+    def __init__(self, method, logfunc=log_stderr):
+        self.method = method
+        self.log = logfunc
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self.timeout = None     #seconds, set by AsyncServerProxy
+    def __repr__(self):
+        return "<Future %s, %s>" % (self.method, "done" if self.done() else "pending")
+    def done(self):
+        """return True once the result (or error) is known"""
+        return self._event.is_set()
+    def result(self, timeout=None):
+        """wait for the call to finish and return its result
+
+        :Parameters:
+            - timeout: seconds to wait, None=until the call is done
+        :Raises: the RPCFault/RPCTransportError of the call, or
+                 RPCTimeoutError if it is not done after timeout seconds
+        """
+        if not self._event.wait(timeout):
+            raise RPCTimeoutError("%s not done after %s seconds" % (self.method, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+    def exception(self, timeout=None):
+        """wait for the call to finish and return its error, or None"""
+        if not self._event.wait(timeout):
+            raise RPCTimeoutError("%s not done after %s seconds" % (self.method, timeout))
+        return self._error
+    def add_done_callback(self, fn):
+        """call fn(future) once the call is done (at once if it already is)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append( fn )
+                return
+        self._run( fn )
+    def set_result(self, result):
+        """finish the call with result (ignored if it is done already)"""
+        self._set( result=result )
+    def set_exception(self, error):
+        """finish the call with error (ignored if it is done already)"""
+        self._set( error=error )
+    def _set(self, result=None, error=None):
+        """set the result or error; only the first call counts
+
+        :Returns: True if this call set it
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._run( fn )
+        return True
+    def _run(self, fn):
+        """call the callback fn, logging what it raises"""
+        try:
+            fn( self )
+        except Exception:
+            self.log( "exception in a callback of %s:\n%s" % (self.method, traceback.format_exc()) )
+
+class AsyncServerProxy:
+    """RPC-client for many concurrent calls.
+
+    Calls return a Future at once instead of blocking. Up to
+    `max_in_flight` calls are sent at a time, each on a connection of its
+    own from a TransportPool (so a multi-worker server can answer them in
+    parallel); further calls wait in line. A call that is not done after
+    `timeout` seconds (counted from the call, including the time waiting
+    in line) fails with RPCTimeoutError; if it was already sent, its
+    response is discarded when it arrives.
+
+    Python 2 has no asyncio, so the calls are made by worker threads.
+
+    :Example:
+        >>> proxy = AsyncServerProxy( JsonRpc20(), lambda: TransportTcpIp(addr=("127.0.0.1",31415), keepalive=True), max_in_flight=4 )
+        >>> futures = [proxy.echo(s) for s in ("hello", "world")]
+        >>> [f.result() for f in futures]
+        [u'hello', u'world']
+        >>> proxy._call( "sleep", (5,), timeout=0.5 ).result()         #per-call timeout
+        Traceback (most recent call last):
+          ...
+        RPCTimeoutError: sleep timed out
+        >>> proxy._close()
+    """
+    def __init__( self, data_serializer, factory, max_in_flight=8, timeout=None, logfunc=log_dummy ):
+        """
+        :Parameters:
+            - data_serializer: a data_structure+serializer-instance
+            - factory: function returning a new (keep-alive) transport,
+              or a TransportPool
+            - max_in_flight: maximum number of calls sent at a time
+            - timeout: default timeout of a call in seconds, None=no timeout
+            - logfunc: function for logging, logfunc(message)
+        """
+        if isinstance(factory, TransportPool):
+            self.__pool = factory
+        else:
+            self.__pool = TransportPool( factory, max_size=max_in_flight, logfunc=logfunc )
+        self.__proxy = ServerProxy( data_serializer, self.__pool )
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.log = logfunc
+        self.__pending = Queue.Queue()
+        self.__expiries = []        #heap of (expiry time, future)
+        self.__cond = threading.Condition()
+        self.__threads = []
+        for i in range(max_in_flight):
+            t = threading.Thread( target=self.__work )
+            t.daemon = True
+            t.start()
+            self.__threads.append( t )
+        t = threading.Thread( target=self.__watch )
+        t.daemon = True
+        t.start()
+    def __repr__(self):
+        return "<AsyncServerProxy for %s, %d in flight>" % (self.__pool, self.max_in_flight)
+
+    def _call( self, methodname, args=(), kwargs=None, timeout=None ):
+        """call methodname(*args, **kwargs) on the server
+
+        :Parameters:
+            - timeout: timeout in seconds, default: self.timeout
+        :Returns: a Future
+        """
+        future = Future( methodname )
+        if timeout is None:
+            timeout = self.timeout
+        future.timeout = timeout
+        if timeout is not None:
+            with self.__cond:
+                heapq.heappush( self.__expiries, (time.time() + timeout, future) )
+                self.__cond.notify()
+        self.__pending.put( (future, args, kwargs or {}) )
+        return future
+    def __req( self, methodname, args=None, kwargs=None ):
+        return self._call( methodname, args, kwargs )
+    def __getattr__( self, name ):
+        return _method(self.__req, name)
+
+    def __work( self ):
+        while 1:
+            call = self.__pending.get()
+            if call is None:
+                return
+            future, args, kwargs = call
+            if future.done():       #timed out while waiting
+                continue
+            try:
+                result = getattr(self.__proxy, future.method)( *args, **kwargs )
+            except RPCError, err:
+                future._set( error=err )
+            except Exception, err:
+                future._set( error=RPCTransportError(err) )
+            else:
+                if not future._set( result=result ):
+                    self.log( "discard late response to %s" % future.method )
+            if future.timeout is not None:
+                with self.__cond:       #let __watch forget it
+                    self.__cond.notify()
+    def __watch( self ):
+        """fail calls whose timeout has passed
+
+        Finished calls are dropped once they are the next to expire, so
+        that the thread sleeps without a timeout when nothing is pending.
+        """
+        with self.__cond:
+            while self.__threads:
+                now = time.time()
+                while self.__expiries and (self.__expiries[0][0] <= now or self.__expiries[0][1].done()):
+                    expires, future = heapq.heappop( self.__expiries )
+                    future._set( error=RPCTimeoutError("%s timed out" % future.method) )
+                if self.__expiries:
+                    self.__cond.wait( self.__expiries[0][0] - now )
+                else:
+                    self.__cond.wait()
+
+    def _close( self ):
+        """stop the worker threads, once the pending calls are done, and close the connections"""
+        for t in self.__threads:
+            self.__pending.put( None )
+        for t in self.__threads:
+            t.join()
+        with self.__cond:
+            self.__threads = []
+            self.__cond.notify()
+        self.__pool.close()
+
 # request dispatcher
 class _method:
     """some "magic" to bind an RPC method to an RPC server.
@@ -949,12 +1887,13 @@ class Server:
         - mixed JSON-RPC 1.0/2.0 server?
         - logging/loglevels?
     """
-    def __init__( self, data_serializer, transport, logfile=None ):
+    def __init__( self, data_serializer, transport, logfile=None, batch_workers=1 ):
         """
         :Parameters:
             - data_serializer: a data_structure+serializer-instance
             - transport: a Transport instance
             - logfile: file to log ("unexpected") errors to
+            - batch_workers: number of calls of a batch to run concurrently
         """
         #TODO: check parameters
         self.__data_serializer = data_serializer
@@ -962,6 +1901,7 @@ class Server:
             raise ValueError('invalid "transport" (must be a Transport-instance)"')
         self.__transport = transport
         self.logfile = logfile
+        self.batch_workers = batch_workers
         if self.logfile is not None:    #create logfile (or raise exception)
             f = codecs.open( self.logfile, 'a', encoding='utf-8' )
             f.close()
@@ -1019,20 +1959,86 @@ class Server:
         :Returns: the data to send back or None if nothing should be sent back
         :Raises:  RPCFault (and maybe others)
         """
-        #TODO: id
-        notification = False
+        is_batch = getattr(self.__data_serializer, "is_batch", None)
+        if is_batch is not None and is_batch( rpcstr ):
+            return self.handle_batch( rpcstr )
+        start = time.time()
         try:
             req = self.__data_serializer.loads_request( rpcstr )
-            if len(req) == 2:       #notification
-                method, params = req
-                notification = True
-            else:                   #request
-                method, params, id = req
         except RPCFault, err:
             return self.__data_serializer.dumps_error( err, id=None )
         except Exception, err:
             self.log( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
             return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id=None )
+        return self._call( req, (start, time.time()) )
+
+    def handle_batch(self, rpcstr):
+        """Handle a JSON-RPC 2.0 batch of requests.
+
+        The calls are run by up to `batch_workers` threads at once.
+
+        :Returns: the batch of responses, or None if all were notifications
+        """
+        try:
+            with tracing.span( "server.deserialize", batch=True ):
+                reqs = self.__data_serializer.loads_batch_request( rpcstr )
+        except RPCFault, err:
+            return self.__data_serializer.dumps_error( err, id=None )
+        except Exception, err:
+            self.log( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
+            return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id=None )
+
+        responses = [None] * len(reqs)
+        pending = Queue.Queue()
+        for i, req in enumerate(reqs):
+            pending.put( (i, req) )
+        received = getattr(request_context, 'received', None)
+        def work():
+            request_context.received = received
+            while 1:
+                try:
+                    i, req = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                if isinstance(req, RPCFault):
+                    responses[i] = self.__data_serializer.dumps_error( req, id=None )
+                else:
+                    responses[i] = self._call( req )
+        threads = [threading.Thread( target=work ) for i in range(min(self.batch_workers, len(reqs)) - 1)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        work()
+        for t in threads:
+            t.join()
+        tracing.set_request_id( None )      #the transport's spans are those of the whole batch
+
+        responses = [response for response in responses if response is not None]
+        if not responses:
+            return None
+        return self.__data_serializer.dumps_batch( responses )
+
+    def _call(self, req, deserialized=None):
+        """call the function for a de-serialized request
+
+        The id of the request is set as the request id for tracing (see
+        tracing.request()) and stays set for the transport's spans.
+
+        :Parameters:
+            - deserialized: (start, end) of de-serializing the request, for tracing
+        :Returns: the serialized response, or None for notifications
+        """
+        notification = False
+        if len(req) == 2:       #notification
+            method, params = req
+            notification = True
+            id = None
+        else:                   #request
+            method, params, id = req
+        if tracing.tracer is not None:
+            tracing.set_request_id( id )
+            if deserialized is not None:
+                tracing.add( "server.deserialize", *deserialized )
 
         if method not in self.funcs:
             if notification:
@@ -1040,14 +2046,15 @@ class Server:
             return self.__data_serializer.dumps_error( RPCFault(METHOD_NOT_FOUND, ERROR_MESSAGE[METHOD_NOT_FOUND]), id )
 
         try:
-            if isinstance(params, dict):
-                result = self.funcs[method]( **params )
-            else:
-                result = self.funcs[method]( *params )
+            with tracing.span( "server.call", method=method ):
+                if isinstance(params, dict):
+                    result = self.funcs[method]( **params )
+                else:
+                    result = self.funcs[method]( *params )
         except RPCFault, err:
             if notification:
                 return None
-            return self.__data_serializer.dumps_error( err, id=None )
+            return self.__data_serializer.dumps_error( err, id )
         except Exception, err:
             if notification:
                 return None
@@ -1057,17 +2064,65 @@ class Server:
         if notification:
             return None
         try:
-            return self.__data_serializer.dumps_response( result, id )
+            with tracing.span( "server.serialize" ):
+                return self.__data_serializer.dumps_response( result, id )
         except Exception, err:
             self.log( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
             return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id )
 
-    def serve(self, n=None):
+    def refuse(self, error):
+        """Answer a request that is longer than the transport accepts with an
+        INVALID_REQUEST error saying so.
+
+        :Returns: the data to send back
+        """
+        return self.__data_serializer.dumps_error( RPCInvalidRPC(error), id=None )
+
+    def busy(self, rpcstr):
+        """Answer a request that cannot be handled right now with a
+        SERVER_BUSY error.
+
+        :Returns: the data to send back or None for notifications
+        """
+        try:
+            req = self.__data_serializer.loads_request( rpcstr )
+        except RPCFault:
+            return self.__data_serializer.dumps_error( RPCServerBusy(), id=None )
+        if len(req) == 2:           #notification
+            return None
+        return self.__data_serializer.dumps_error( RPCServerBusy(), req[2] )
+
+    def serve_queued(self, n=None, workers=1, max_queue=16):
+        """serve with a pool of worker threads and a bounded request queue,
+        rejecting requests with a SERVER_BUSY error while the queue is full.
+
+        :See: TransportSocket.serve_queued
+        """
+        self.__transport.refuse = self.refuse
+        self.__transport.serve_queued( self.handle, self.busy, n, workers, max_queue )
+
+    def queue_stats(self):
+        """return the depth of the request queue and the number of rejected
+        requests (only for socket-transports).
+
+        :See: TransportSocket.queue_stats
+        """
+        return self.__transport.queue_stats()
+
+    def serve(self, n=None, threaded=False):
         """serve (forever or for n communicaions).
         
+        :Parameters:
+            - threaded: handle connections concurrently (only supported
+              by socket-transports)
         :See: Transport
         """
-        self.__transport.serve( self.handle, n )
+        if hasattr(self.__transport, "refuse"):
+            self.__transport.refuse = self.refuse
+        if threaded:
+            self.__transport.serve( self.handle, n, threaded=True )
+        else:
+            self.__transport.serve( self.handle, n )
 
 #=========================================
 
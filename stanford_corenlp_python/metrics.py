@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Counters and histograms for the CoreNLP server.
+
+A Metrics instance is shared by the parts of the server that record
+something (requests, errors, timeouts, parse times, input lengths).
+stats() returns everything as a dictionary, for the `stats` RPC method;
+render() returns it as plain text, one "name value" line per metric
+(the Prometheus text format), for the scrape endpoint of serve_http().
+"""
+
+import bisect
+import threading
+import time
+import BaseHTTPServer
+
+
+# Upper bounds of the histogram buckets. Names ending in _seconds are times,
+# _chars are input lengths.
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+CHARS_BUCKETS = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def format_number(value):
+    """Formats floats with full precision and integers without a suffix."""
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """Counts observations in buckets with fixed upper bounds."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Returns the count, sum and cumulative bucket counts."""
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of counters and histograms. Values that are
+    kept elsewhere (the cache statistics, the depth of the request queue)
+    are added with register(name, function) and read when reporting.
+    """
+    def __init__(self, prefix='corenlp_'):
+        self.prefix = prefix
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.sources = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                buckets = CHARS_BUCKETS if name.endswith('_chars') else SECONDS_BUCKETS
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register(self, name, function):
+        """Reports function() under name; it returns a number or a dict of numbers."""
+        self.sources[name] = function
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                stats[name] = histogram.snapshot()
+        for name, function in self.sources.items():
+            stats[name] = function()
+        stats['uptime_seconds'] = time.time() - self.started
+        return stats
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for name, value in sorted(self.stats().items()):
+            name = self.prefix + name
+            if isinstance(value, dict) and 'buckets' in value:
+                lines.append("# TYPE %s histogram" % name)
+                for bound, count in value['buckets']:
+                    lines.append('%s_bucket{le="%g"} %d' % (name, bound, count))
+                lines.append('%s_bucket{le="+Inf"} %d' % (name, value['count']))
+                lines.append("%s_sum %s" % (name, format_number(value['sum'])))
+                lines.append("%s_count %d" % (name, value['count']))
+            elif isinstance(value, dict):
+                for key, item in sorted(value.items()):
+                    if is_number(item):
+                        lines.append("%s_%s %s" % (name, key, format_number(item)))
+            elif is_number(value):
+                lines.append("%s %s" % (name, format_number(value)))
+        return "\n".join(lines) + "\n"
+
+
+def serve_http(metrics, host='127.0.0.1', port=8081):
+    """
+    Serves metrics.render() at http://host:port/metrics from a daemon
+    thread and returns the HTTP server.
+    """
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
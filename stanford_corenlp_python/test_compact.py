@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Tests of the compact encoding of parse results.
+Run them from this directory with `python -m unittest discover`.
+"""
+import json
+import unittest
+
+import benchmark
+import compact
+from corenlp import parse_parser_results
+
+
+def as_json(results):
+    """results as a client receives them, with lists instead of tuples"""
+    return json.loads(json.dumps(results))
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.results = parse_parser_results(benchmark.make_transcript(2))
+
+    def test_round_trip(self):
+        encoded = as_json(compact.encode(self.results))
+        self.assertEqual(encoded['format'], compact.FORMAT)
+        self.assertEqual(compact.decode(encoded), as_json(self.results))
+
+    def test_smaller(self):
+        self.assertLess(len(json.dumps(compact.encode(self.results))),
+                        len(json.dumps(self.results)))
+
+    def test_columns(self):
+        sentence = compact.encode(self.results)['sentences'][0]
+        self.assertEqual(sentence['words']['tokens'][:2], ['If', 'Karel'])
+        self.assertEqual(sentence['words']['attrs']['PartOfSpeech'][:2], ['IN', 'NNP'])
+        # only "two" has a normalized tag
+        self.assertEqual(sentence['words']['attrs']['NormalizedNamedEntityTag'],
+                         [None] * 7 + ['2.0'] + [None] * 3)
+        self.assertEqual(sentence['dependencies'][5], ['root', 0, 7])
+
+    def test_dependency_words_kept_if_not_at_index(self):
+        sentence = self.results['sentences'][0]
+        sentence['dependencies'].append(('conj', ('move', 7), ('moved', 12)))
+        encoded = as_json(compact.encode(self.results))
+        self.assertEqual(encoded['sentences'][0]['dependencies'][-1], ['conj', 7, 12, 'move', 'moved'])
+        self.assertEqual(compact.decode(encoded), as_json(self.results))
+
+    def test_other_results_unchanged(self):
+        error = {'error': 'timeout'}
+        self.assertIs(compact.encode(error), error)
+        self.assertIs(compact.decode(self.results), self.results)
+
+
+if __name__ == '__main__':
+    unittest.main()
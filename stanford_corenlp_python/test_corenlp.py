@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Tests of the parts of the CoreNLP wrapper that do not need CoreNLP itself.
+Run them from this directory with `python -m unittest discover`.
+"""
+import time
+import unittest
+
+import benchmark
+from corenlp import parse_parser_results, result_size, CachedParser, LatencyModel, LRUCache
+
+
+class ParserResultsTest(unittest.TestCase):
+    def setUp(self):
+        self.transcript = benchmark.make_transcript(3)
+
+    def test_same_as_baseline(self):
+        self.assertEqual(parse_parser_results(self.transcript),
+                         benchmark.baseline_parser_results(self.transcript))
+
+    def test_sentences(self):
+        results = parse_parser_results(self.transcript)
+        self.assertEqual(len(results['sentences']), 3)
+        sentence = results['sentences'][0]
+        self.assertEqual(sentence['text'], 'If Karel is facing north, move two spaces forward.')
+        self.assertEqual(sentence['words'][7][0], 'two')
+        self.assertEqual(sentence['words'][7][1]['NormalizedNamedEntityTag'], '2.0')
+        self.assertEqual(sentence['dependencies'][5], ('root', ('ROOT', 0), ('move', 7)))
+        self.assertTrue(sentence['parsetree'].startswith('(ROOT (S'))
+        self.assertEqual(results['coref'], [[(('Karel', 1, 1, 1, 2), ('Karel', 0, 1, 1, 2))]])
+
+    def test_optional_sections_left_out(self):
+        results = parse_parser_results(self.transcript, parsetree=False, coref=False)
+        self.assertNotIn('coref', results)
+        self.assertNotIn('parsetree', results['sentences'][0])
+        self.assertEqual(results['sentences'][0]['dependencies'],
+                         parse_parser_results(self.transcript)['sentences'][0]['dependencies'])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = LRUCache()
+        cache.put('a', 1, 10)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['bytes']),
+                         (1, 1, 1, 10))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        cache.get('a')
+        cache.put('c', 3, 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_bounded_by_bytes(self):
+        cache = LRUCache(max_bytes=100)
+        cache.put('a', 1, 60)
+        cache.put('b', 2, 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 60)
+        # too large to be cached at all, and it replaces the old value
+        cache.put('b', 3, 200)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_replace(self):
+        cache = LRUCache()
+        cache.put('a', 1, 10)
+        cache.put('a', 2, 20)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual((cache.stats()['entries'], cache.stats()['bytes']), (1, 20))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.put('a', 1, 10)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['expirations'], stats['entries'], stats['bytes']), (1, 0, 0))
+
+
+class FakeParser(object):
+    """stands in for StanfordCoreNLP, counting its calls"""
+    def __init__(self):
+        self.calls = []
+
+    def annotate(self, text, parsetree=True, coref=True, deadline=None):
+        self.calls.append(text)
+        if not text:
+            return {'error': 'empty text'}
+        return parse_parser_results(benchmark.make_transcript(1), parsetree, coref)
+
+
+class CachedParserTest(unittest.TestCase):
+    def setUp(self):
+        self.nlp = FakeParser()
+        self.cache = LRUCache()
+        self.parser = CachedParser(self.nlp, self.cache)
+
+    def test_repeated_calls_cached(self):
+        first = self.parser.annotate('Move.')
+        self.assertIs(self.parser.annotate('Move.'), first)
+        self.assertEqual(self.parser.parse('Move.'), self.parser.parse('Move.'))
+        self.assertEqual(self.nlp.calls, ['Move.'])
+        self.assertEqual(self.cache.stats()['bytes'], result_size(first))
+
+    def test_options_are_part_of_the_key(self):
+        self.parser.annotate('Move.')
+        self.assertNotIn('coref', self.parser.annotate('Move.', coref=False))
+        self.assertEqual(self.nlp.calls, ['Move.', 'Move.'])
+
+    def test_errors_not_cached(self):
+        self.parser.annotate('')
+        self.parser.annotate('')
+        self.assertEqual(self.nlp.calls, ['', ''])
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+
+class LatencyModelTest(unittest.TestCase):
+    TEN_WORDS = 'Karel moves north and then turns left to pick beepers.'
+
+    def warm(self, model, seconds_per_word=0.1):
+        for _ in range(model.min_samples):
+            model.observe('word ' * 10, seconds_per_word * 10)
+
+    def test_estimate_before_warm_up(self):
+        model = LatencyModel(min_samples=3)
+        self.assertEqual(model.timeout('x' * 40), 5.0)
+        self.assertEqual(model.timeout('x' * 10000), model.maximum)
+        self.assertEqual(model.stats(), {'samples': 0, 'seconds_per_word': None})
+
+    def test_learned_rate(self):
+        model = LatencyModel(min_samples=3)
+        self.warm(model)
+        self.assertAlmostEqual(model.rate(), 0.1)
+        # margin * rate * words + slack
+        self.assertAlmostEqual(model.timeout(self.TEN_WORDS), 3.0 * 0.1 * 10 + 1.0)
+
+    def test_clamped(self):
+        model = LatencyModel(min_samples=3, minimum=2.0, maximum=40.0)
+        self.warm(model)
+        self.assertEqual(model.timeout('Move.'), 2.0)
+        self.assertEqual(model.timeout('word ' * 1000), 40.0)
+
+    def test_window(self):
+        model = LatencyModel(window=3, min_samples=3)
+        self.warm(model, 1.0)
+        self.warm(model, 0.1)
+        self.assertAlmostEqual(model.rate(), 0.1)
+
+    def test_timeouts_raise_the_limit(self):
+        model = LatencyModel(min_samples=3, quantile=1.0)
+        self.warm(model)
+        before = model.timeout(self.TEN_WORDS)
+        model.observe_timeout(self.TEN_WORDS, 1.0)
+        # counted as taking the whole timeout, not the second it was given
+        self.assertAlmostEqual(model.rate(), before / 10)
+        self.assertGreater(model.timeout(self.TEN_WORDS), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
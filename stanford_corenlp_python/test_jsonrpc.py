@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""
+Tests of the JSON-RPC transports, client and server, against servers
+running in threads of the test process (no CoreNLP needed). Run them from
+this directory with `python -m unittest discover`.
+"""
+import errno
+import socket
+import StringIO
+import sys
+import threading
+import time
+import unittest
+
+import jsonrpc
+
+
+def free_addr():
+    """return an address nothing listens on (yet)"""
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    addr = s.getsockname()
+    s.close()
+    return addr
+
+
+def echo(value):
+    return value
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def too_late(value):
+    raise jsonrpc.RPCFault(1, "deadline passed", value)
+
+
+def start_server(functions=(echo,), queued=False, timeout=5.0, max_message=jsonrpc.MAX_MESSAGE,
+                 **serve_args):
+    """serve functions in a daemon thread, and return the address once it accepts connections"""
+    addr = free_addr()
+    server = jsonrpc.Server(jsonrpc.JsonRpc20(),
+                            jsonrpc.TransportTcpIp(addr=addr, timeout=timeout,
+                                                   max_message=max_message))
+    for function in functions:
+        server.register_function(function)
+    serve = server.serve_queued if queued else server.serve
+    thread = threading.Thread(target=serve, kwargs=serve_args)
+    thread.daemon = True
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(addr).close()
+            return addr
+        except socket.error:
+            time.sleep(0.01)
+    raise RuntimeError("server did not start")
+
+
+def proxy(addr, keepalive=True, timeout=2.0, **transport_args):
+    return jsonrpc.ServerProxy(jsonrpc.JsonRpc20(),
+                               jsonrpc.TransportTcpIp(addr=addr, keepalive=keepalive,
+                                                      timeout=timeout, **transport_args))
+
+
+class TransportSocketTest(unittest.TestCase):
+    def test_serve_on_busy_port(self):
+        taken = socket.socket()
+        taken.bind(('127.0.0.1', 0))
+        taken.listen(1)
+        try:
+            transport = jsonrpc.TransportTcpIp(addr=taken.getsockname())
+            with self.assertRaises(socket.error) as raised:
+                transport.serve(echo, n=1)
+            self.assertEqual(raised.exception.errno, errno.EADDRINUSE)
+        finally:
+            taken.close()
+
+    def test_unframed_client(self):
+        addr = start_server()
+        self.assertEqual(proxy(addr, keepalive=False).echo("hello"), "hello")
+
+    def test_keepalive_reuses_connection(self):
+        transport = jsonrpc.TransportTcpIp(addr=start_server(), keepalive=True, timeout=2.0)
+        client = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), transport)
+        self.assertEqual(client.echo(1), 1)
+        conn = transport.s
+        self.assertEqual(client.echo([2, "two"]), [2, "two"])
+        self.assertIs(transport.s, conn)
+
+    def test_idle_keepalive_connection_does_not_block(self):
+        # the default server handles one request at a time
+        addr = start_server()
+        first, second = proxy(addr), proxy(addr)
+        self.assertEqual(first.echo("first"), "first")
+        self.assertEqual(second.echo("second"), "second")
+        self.assertEqual(proxy(addr, keepalive=False).echo("third"), "third")
+        self.assertEqual(first.echo("again"), "again")
+
+    def test_reconnects_after_server_closed_connection(self):
+        transport = jsonrpc.TransportTcpIp(addr=start_server(), keepalive=True, timeout=2.0)
+        client = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), transport)
+        self.assertEqual(client.echo(1), 1)
+        # as if the server had dropped the idle connection
+        transport.s.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(client.echo(2), 2)
+
+    def test_netstring(self):
+        self.assertEqual(jsonrpc.netstring("abc"), "3:abc,")
+        self.assertEqual(jsonrpc.netstring(""), "0:,")
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.addr = start_server(functions=(echo, too_late))
+
+    def test_results_by_id(self):
+        with proxy(self.addr)._batch() as batch:
+            calls = [batch.echo(i) for i in range(5)]
+        self.assertEqual([call.result() for call in calls], range(5))
+
+    def test_fault_of_one_call(self):
+        with proxy(self.addr)._batch() as batch:
+            before, late, after = batch.echo("a"), batch.too_late("b"), batch.echo("c")
+        self.assertEqual(before.result(), "a")
+        self.assertEqual(after.result(), "c")
+        with self.assertRaises(jsonrpc.RPCFault) as raised:
+            late.result()
+        self.assertEqual(raised.exception.error_code, 1)
+        self.assertEqual(raised.exception.error_data, "b")
+
+    def test_not_sent_yet(self):
+        batch = proxy(self.addr)._batch()
+        call = batch.echo(1)
+        self.assertRaises(jsonrpc.RPCError, call.result)
+        batch.send()
+        self.assertEqual(call.result(), 1)
+
+    def test_notifications_only(self):
+        notifications = '[{"jsonrpc": "2.0", "method": "echo", "params": [1]}]'
+        transport = jsonrpc.TransportTcpIp(addr=self.addr, keepalive=True, timeout=2.0)
+        # answered with an empty frame, so that the client does not wait for nothing
+        self.assertEqual(transport.sendrecv(notifications), "")
+        self.assertEqual(jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), transport).echo(2), 2)
+
+
+class MessageSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.addr = start_server(max_message=200)
+
+    def assertRefused(self, client):
+        with self.assertRaises(jsonrpc.RPCInvalidRPC) as raised:
+            client.echo("x" * 1000)
+        self.assertIn("max_message (200 bytes)", raised.exception.error_data)
+
+    def test_framed_request_too_long(self):
+        client = proxy(self.addr)
+        self.assertRefused(client)
+        self.assertEqual(client.echo("short"), "short")
+
+    def test_unframed_request_too_long(self):
+        self.assertRefused(proxy(self.addr, keepalive=False))
+        self.assertEqual(proxy(self.addr, keepalive=False).echo("short"), "short")
+
+    def test_response_too_long(self):
+        client = proxy(start_server(), max_message=200)
+        with self.assertRaises(jsonrpc.RPCTransportError) as raised:
+            client.echo("x" * 1000)
+        self.assertIn("longer than max_message (200 bytes)", str(raised.exception))
+
+
+class ServeQueuedTest(unittest.TestCase):
+    def call_later(self, addr, delay, method, *args):
+        """call method in a thread after delay seconds; returns the list its result or error goes to"""
+        outcome = []
+        def call():
+            time.sleep(delay)
+            try:
+                outcome.append(getattr(proxy(addr, timeout=5.0), method)(*args))
+            except jsonrpc.RPCError, err:
+                outcome.append(err)
+        thread = threading.Thread(target=call)
+        thread.start()
+        self.addCleanup(thread.join)
+        return outcome
+
+    def test_results(self):
+        addr = start_server(queued=True, workers=2)
+        clients = [proxy(addr), proxy(addr), proxy(addr, keepalive=False)]
+        for i in range(3):
+            self.assertEqual([client.echo(i) for client in clients], [i, i, i])
+
+    def test_busy_when_queue_full(self):
+        addr = start_server(functions=(echo, sleep), queued=True, workers=1, max_queue=1)
+        # the worker handles the first call, the second waits in the queue
+        first = self.call_later(addr, 0.0, "sleep", 0.5)
+        second = self.call_later(addr, 0.1, "echo", "queued")
+        time.sleep(0.2)
+        with self.assertRaises(jsonrpc.RPCServerBusy) as raised:
+            proxy(addr).echo("rejected")
+        self.assertEqual(raised.exception.error_code, jsonrpc.SERVER_BUSY)
+        self.assertRaises(jsonrpc.RPCServerBusy, proxy(addr, keepalive=False).echo, "rejected")
+        time.sleep(0.5)
+        self.assertEqual((first, second), ([0.5], ["queued"]))
+        self.assertEqual(proxy(addr).echo("later"), "later")
+
+    def test_busy_keepalive_connection_stays_open(self):
+        addr = start_server(functions=(echo, sleep), queued=True, workers=1, max_queue=1)
+        client = proxy(addr)
+        self.assertEqual(client.echo(1), 1)
+        self.call_later(addr, 0.0, "sleep", 0.5)
+        self.call_later(addr, 0.1, "sleep", 0.1)
+        time.sleep(0.2)
+        self.assertRaises(jsonrpc.RPCServerBusy, client.echo, 2)
+        time.sleep(0.6)
+        self.assertEqual(client.echo(3), 3)
+
+
+class FakeTransport(jsonrpc.Transport):
+    """transport answering with what it was sent, or failing if told to"""
+    def __init__(self):
+        self.closed = False
+        self.fail = False
+    def sendrecv(self, string):
+        if self.fail:
+            raise jsonrpc.RPCTransportError("connection reset")
+        return string
+    def close(self):
+        self.closed = True
+
+
+class TransportPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.created = []
+
+    def factory(self):
+        transport = FakeTransport()
+        self.created.append(transport)
+        return transport
+
+    def test_reuses_idle_transport(self):
+        pool = jsonrpc.TransportPool(self.factory)
+        self.assertEqual(pool.sendrecv("a"), "a")
+        self.assertEqual(pool.sendrecv("b"), "b")
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual((pool.size, len(pool.idle)), (1, 1))
+
+    def test_max_size(self):
+        pool = jsonrpc.TransportPool(self.factory, max_size=2, wait_timeout=0.05)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertRaises(jsonrpc.RPCTransportError, pool.acquire)
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(len(self.created), 2)
+
+    def test_waits_for_released_transport(self):
+        pool = jsonrpc.TransportPool(self.factory, max_size=1, wait_timeout=2.0)
+        transport = pool.acquire()
+        threading.Timer(0.05, pool.release, (transport,)).start()
+        self.assertIs(pool.acquire(), transport)
+
+    def test_broken_transport_is_closed(self):
+        pool = jsonrpc.TransportPool(self.factory, max_size=1)
+        pool.sendrecv("a")
+        self.created[0].fail = True
+        self.assertRaises(jsonrpc.RPCTransportError, pool.sendrecv, "b")
+        self.assertTrue(self.created[0].closed)
+        self.assertEqual(pool.size, 0)
+        self.assertEqual(pool.sendrecv("c"), "c")
+        self.assertEqual(len(self.created), 2)
+
+    def test_failing_factory_frees_its_place(self):
+        def refuse():
+            raise jsonrpc.RPCTransportError("connection refused")
+        pool = jsonrpc.TransportPool(refuse, max_size=1, wait_timeout=0.05)
+        for _ in range(2):
+            self.assertRaises(jsonrpc.RPCTransportError, pool.acquire)
+        self.assertEqual(pool.size, 0)
+
+    def test_idle_transports_evicted(self):
+        pool = jsonrpc.TransportPool(self.factory, idle_timeout=0.0)
+        pool.sendrecv("a")
+        time.sleep(0.01)
+        pool.sendrecv("b")
+        self.assertTrue(self.created[0].closed)
+        self.assertEqual(len(self.created), 2)
+        pool.close()
+        self.assertTrue(self.created[1].closed)
+        self.assertEqual(pool.size, 0)
+
+    def test_threads_share_connections(self):
+        addr = start_server(threaded=True)
+        pool = jsonrpc.TransportPool(
+            lambda: jsonrpc.TransportTcpIp(addr=addr, keepalive=True, timeout=2.0), max_size=3)
+        client = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), pool)
+        results = []
+        def call(i):
+            results.append(client.echo(i))
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), range(10))
+        self.assertLessEqual(pool.size, 3)
+        pool.close()
+
+
+def fail(future):
+    raise ValueError("callback failed")
+
+
+class CapturedStderr(object):
+    """with-block collecting what is written to sys.stderr"""
+    def __enter__(self):
+        self.saved, sys.stderr = sys.stderr, StringIO.StringIO()
+        return sys.stderr
+    def __exit__(self, *exc_info):
+        sys.stderr = self.saved
+
+
+class FutureTest(unittest.TestCase):
+    def test_result_and_callbacks(self):
+        future = jsonrpc.Future("echo")
+        done = []
+        future.add_done_callback(done.append)
+        self.assertFalse(future.done())
+        self.assertTrue(future._set(result=1))
+        self.assertFalse(future._set(result=2))
+        self.assertEqual(future.result(), 1)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def test_exception(self):
+        future = jsonrpc.Future("echo")
+        self.assertRaises(jsonrpc.RPCTimeoutError, future.result, 0.01)
+        future.set_exception(jsonrpc.RPCTransportError("down"))
+        self.assertRaises(jsonrpc.RPCTransportError, future.result)
+        self.assertIsInstance(future.exception(), jsonrpc.RPCTransportError)
+
+    def test_raising_callback(self):
+        future = jsonrpc.Future("echo")
+        done = []
+        future.add_done_callback(fail)
+        future.add_done_callback(done.append)
+        with CapturedStderr() as stderr:
+            future.set_result(1)
+            future.add_done_callback(fail)
+        self.assertEqual(done, [future])
+        self.assertEqual(stderr.getvalue().count("ValueError: callback failed"), 2)
+
+
+class AsyncServerProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.addr = start_server(functions=(echo, sleep), threaded=True)
+        self.proxies = []
+
+    def tearDown(self):
+        for proxy in self.proxies:
+            proxy._close()
+
+    def async_proxy(self, **args):
+        factory = lambda: jsonrpc.TransportTcpIp(addr=self.addr, keepalive=True, timeout=5.0)
+        proxy = jsonrpc.AsyncServerProxy(jsonrpc.JsonRpc20(), factory, **args)
+        self.proxies.append(proxy)
+        return proxy
+
+    def test_results(self):
+        proxy = self.async_proxy()
+        futures = [proxy.echo(i) for i in range(10)]
+        self.assertEqual([future.result(5) for future in futures], range(10))
+
+    def test_calls_in_parallel(self):
+        proxy = self.async_proxy(max_in_flight=4)
+        start = time.time()
+        futures = [proxy.sleep(0.3) for _ in range(4)]
+        for future in futures:
+            future.result(5)
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_timeout(self):
+        proxy = self.async_proxy(max_in_flight=1)
+        start = time.time()
+        slow = proxy._call("sleep", (1,), timeout=0.2)
+        self.assertRaises(jsonrpc.RPCTimeoutError, slow.result, 5)
+        self.assertLess(time.time() - start, 0.9)
+        # the late response is discarded, and the worker goes on with the next call
+        self.assertEqual(proxy.echo("next").result(5), "next")
+
+    def test_raising_callback_does_not_stop_worker(self):
+        proxy = self.async_proxy(max_in_flight=1)
+        with CapturedStderr() as stderr:
+            first = proxy.sleep(0.1)
+            first.add_done_callback(fail)
+            second = proxy.echo("second")
+            self.assertEqual(second.result(5), "second")
+        self.assertTrue(first.done())
+        self.assertIn("ValueError: callback failed", stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Timed spans of the phases of a request, to find out where the time of a
+slow request went: serialization, socket I/O, queueing, the parse in the
+JVM or reading its output.
+
+Tracing is off until enable() is called, and span() and add() then cost
+next to nothing. Each span is tagged with the id of the request the
+current thread works on (see request()). The JSON-RPC client sends its
+request ids to the server as the JSON-RPC id, so that the spans of a
+request can be followed from the client through the server. dump()
+writes the spans as Chrome trace events, which chrome://tracing and
+Perfetto show as a timeline; traces of the client and the server can be
+loaded together.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+# the request id of each thread
+context = threading.local()
+
+# the Tracer spans are recorded by, or None if tracing is off
+tracer = None
+
+
+class Tracer(object):
+    """
+    Keeps the last `max_spans` spans. If logfunc is given (one of the
+    jsonrpc.log_* functions), each span is also logged as it ends.
+    """
+    def __init__(self, max_spans=100000, logfunc=None):
+        self.spans = deque(maxlen=max_spans)
+        self.logfunc = logfunc
+        self.pid = os.getpid()
+        self.ids = itertools.count(1)
+
+    def new_request_id(self):
+        """Returns an id that is unique across the processes of a host."""
+        return '%d-%d' % (self.pid, next(self.ids))
+
+    def add(self, name, start, end, **args):
+        """Records a span from start to end (in time.time() seconds)."""
+        request_id = getattr(context, 'request_id', None)
+        if request_id is not None:
+            args['request_id'] = request_id
+        self.spans.append((name, start, end, threading.current_thread().ident, args))
+        if self.logfunc is not None:
+            self.logfunc("%s %.3f ms %s" % (name, (end - start) * 1000, args))
+
+    def events(self):
+        """Returns the spans as Chrome trace events (complete events, in microseconds)."""
+        return [{'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'ts': start * 1e6,
+                 'dur': (end - start) * 1e6, 'pid': self.pid, 'tid': tid, 'args': args}
+                for name, start, end, tid, args in list(self.spans)]
+
+    def dump(self, path):
+        """Writes the spans to path in the Chrome trace format and returns their number."""
+        events = self.events()
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+    def clear(self):
+        self.spans.clear()
+
+
+class Span(object):
+    """Records the time spent in a with-block."""
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add(self.name, self.start, time.time(), **self.args)
+        return False
+
+
+class RequestContext(object):
+    """Sets the request id of the current thread in a with-block."""
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+    def __enter__(self):
+        self.previous = getattr(context, 'request_id', None)
+        context.request_id = self.request_id
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        context.request_id = self.previous
+        return False
+
+
+class NullContext(object):
+    """Stands in for Span and RequestContext while tracing is off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_CONTEXT = NullContext()
+
+
+def enable(max_spans=100000, logfunc=None):
+    """Starts tracing and returns the Tracer."""
+    global tracer
+    tracer = Tracer(max_spans, logfunc)
+    return tracer
+
+
+def disable():
+    global tracer
+    tracer = None
+
+
+def span(name, **args):
+    """Returns a context manager recording its with-block as a span."""
+    if tracer is None:
+        return NULL_CONTEXT
+    return Span(tracer, name, args)
+
+
+def add(name, start, end, **args):
+    """Records a span of which the start and end are already known."""
+    if tracer is not None:
+        tracer.add(name, start, end, **args)
+
+
+def new_request_id():
+    """Returns a new request id, or None while tracing is off."""
+    if tracer is None:
+        return None
+    return tracer.new_request_id()
+
+
+def request(request_id):
+    """Returns a context manager in which spans are tagged with request_id."""
+    if tracer is None:
+        return NULL_CONTEXT
+    return RequestContext(request_id)
+
+
+def set_request_id(request_id):
+    """Tags the following spans of the current thread with request_id."""
+    context.request_id = request_id
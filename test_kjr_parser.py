@@ -0,0 +1,156 @@
+# [SublimeLinter @python:2]
+
+from __future__ import print_function
+
+import os
+import threading
+import unittest
+
+import kjr_parser
+from kjr_parser import FastPath, Lexeme, MoveAction, TurnAction, WordType, lookup_word
+from log import LEVELS
+from stanford_corenlp_python import jsonrpc
+
+
+class FastPathTest(unittest.TestCase):
+    '''The fast path needs no CoreNLP server, so these run without one.'''
+    def setUp(self):
+        self.fast_path = FastPath()
+
+    def test_simple_commands(self):
+        grouping = self.fast_path.match('Turn left twice.')
+        self.assertEqual(grouping.verb.word, 'turn')
+        self.assertEqual([dep.word for dep in grouping.directions], ['left'])
+        self.assertEqual([dep.word for dep in grouping.numbers], ['twice'])
+        actions = kjr_parser.build_actions([grouping])
+        self.assertEqual(len(actions), 1)
+        self.assertIsInstance(actions[0], TurnAction)
+        self.assertEqual(actions[0].times, 2)
+
+    def test_fillers_and_move_nouns(self):
+        grouping = self.fast_path.match('Karel should move two spaces north.')
+        self.assertEqual(grouping.verb.word, 'move')
+        self.assertIsNone(grouping.object)
+        actions = kjr_parser.build_actions([grouping])
+        self.assertEqual([action.__class__ for action in actions], [TurnAction, MoveAction])
+        self.assertEqual(actions[0].cardinal, 'north')
+        self.assertEqual(actions[1].steps, 2)
+
+    def test_beeper_object(self):
+        grouping = self.fast_path.match('Put down two beepers.')
+        self.assertEqual(grouping.verb.word, 'put')
+        self.assertEqual(grouping.object.word, 'beeper')
+
+    def test_needs_full_parse(self):
+        for sentence in ['If there is a beeper, pick it up.', 'Move the wall.',
+                         'Move. Turn left.', 'Turn left and move.', 'Move two beepers.', '']:
+            self.assertIsNone(self.fast_path.match(sentence), sentence)
+
+    def test_pending_sentences(self):
+        parts, groupings, pending = kjr_parser.match_fast_path(
+            'Turn left. If there is a beeper, pick it up. Move twice.')
+        self.assertEqual(len(parts), 3)
+        self.assertEqual([grouping is None for grouping in groupings], [False, True, False])
+        self.assertEqual(pending, ['If there is a beeper, pick it up.'])
+
+    def test_count_from_threads(self):
+        def count():
+            for _ in range(1000):
+                self.fast_path.count(hits=2, misses=1)
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.fast_path.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (16000, 8000))
+
+
+@unittest.skipIf(kjr_parser.fast_path is None, 'the fast path is turned off (KJR_FAST_PATH=0)')
+class IterParseSentencesTest(unittest.TestCase):
+    '''Replaces the CoreNLP requests of kjr_parser, to see when they are made.'''
+    def setUp(self):
+        self.saved = kjr_parser.get_corenlp_result, kjr_parser.get_corenlp_result_async
+        self.future = jsonrpc.Future('annotate')
+        self.requested = []
+        kjr_parser.get_corenlp_result_async = self.request_async
+        kjr_parser.get_corenlp_result = self.request
+
+    def tearDown(self):
+        kjr_parser.get_corenlp_result, kjr_parser.get_corenlp_result_async = self.saved
+
+    def request_async(self, text):
+        self.requested.append(text)
+        return self.future
+
+    def request(self, text):
+        self.requested.append(text)
+        return {'sentences': []}
+
+    def test_leading_fast_path_actions_come_first(self):
+        actions = kjr_parser.iter_parse_sentences('Turn left. If there is a beeper, pick it up.')
+        self.assertIsInstance(next(actions), TurnAction)
+        self.assertFalse(self.future.done())
+        self.assertEqual(self.requested, ['If there is a beeper, pick it up.'])
+        # CoreNLP found no sentences, so they cannot be lined up: only the rest is parsed again
+        self.future.set_result({'sentences': []})
+        self.assertEqual(list(actions), [])
+        self.assertEqual(self.requested, ['If there is a beeper, pick it up.'] * 2)
+
+    def test_fast_path_only(self):
+        actions = list(kjr_parser.iter_parse_sentences('Turn left. Move twice.'))
+        self.assertEqual([action.__class__ for action in actions], [TurnAction, MoveAction])
+        self.assertEqual(self.requested, [])
+
+
+class LookupWordTest(unittest.TestCase):
+    def test_surface_form_first(self):
+        self.assertEqual(lookup_word('has', 'have', 'VBZ'), Lexeme(WordType.condVerb, 'has'))
+        self.assertEqual(lookup_word('beepers', 'beeper', 'NNS'), Lexeme(WordType.beeper, 'beeper'))
+
+    def test_verb_by_lemma(self):
+        self.assertEqual(lookup_word('moves', 'move', 'VBZ'), Lexeme(WordType.verb, 'move'))
+        self.assertEqual(lookup_word('turned', 'turn', 'VBD'), Lexeme(WordType.verb, 'turn'))
+
+    def test_noun_not_by_verb_lemma(self):
+        self.assertIsNone(lookup_word('turns', 'turn', 'NNS'))
+        self.assertIsNone(lookup_word('moves', 'move', 'NNS'))
+
+    def test_lemma_needs_tag(self):
+        self.assertIsNone(lookup_word('moves', 'move'))
+        self.assertIsNone(lookup_word('moving', 'move', None))
+
+
+class EnvChoiceTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = os.environ.pop('KJR_TEST_CHOICE', None)
+
+    def tearDown(self):
+        os.environ.pop('KJR_TEST_CHOICE', None)
+        if self.saved is not None:
+            os.environ['KJR_TEST_CHOICE'] = self.saved
+
+    def test_default(self):
+        self.assertEqual(kjr_parser.env_choice('KJR_TEST_CHOICE', LEVELS, 'details'), 'details')
+
+    def test_valid(self):
+        os.environ['KJR_TEST_CHOICE'] = 'actions'
+        self.assertEqual(kjr_parser.env_choice('KJR_TEST_CHOICE', LEVELS, 'details'), 'actions')
+
+    def test_invalid_falls_back(self):
+        os.environ['KJR_TEST_CHOICE'] = 'verbose'
+        self.assertEqual(kjr_parser.env_choice('KJR_TEST_CHOICE', LEVELS, 'details'), 'details')
+
+    def test_int(self):
+        self.assertEqual(kjr_parser.env_int('KJR_TEST_CHOICE', 4), 4)
+        os.environ['KJR_TEST_CHOICE'] = '8'
+        self.assertEqual(kjr_parser.env_int('KJR_TEST_CHOICE', 4), 8)
+
+    def test_bad_int_falls_back(self):
+        for value in ['four', '2.5', '', '0']:
+            os.environ['KJR_TEST_CHOICE'] = value
+            self.assertEqual(kjr_parser.env_int('KJR_TEST_CHOICE', 4), 4, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
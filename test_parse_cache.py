@@ -0,0 +1,49 @@
+# [SublimeLinter @python:2]
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from parse_cache import ParseCache
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_normalized_hits(self):
+        cache = ParseCache(self.path, 'config')
+        cache.put('Turn  left.', {'sentences': []})
+        self.assertEqual(cache.get('Turn left.'), {'sentences': []})
+        self.assertIsNone(cache.get('Turn right.'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1})
+        self.assertIsNone(ParseCache(self.path, 'other config').get('Turn left.'))
+
+    def test_evicts_least_recently_used(self):
+        cache = ParseCache(self.path, max_entries=2)
+        cache.put('first', {'n': 1})
+        cache.put('second', {'n': 2})
+        # The hit is only written with the next put, but before it evicts
+        cache.get('first')
+        cache.put('third', {'n': 3})
+        self.assertEqual(cache.get('first'), {'n': 1})
+        self.assertIsNone(cache.get('second'))
+
+    def test_flush(self):
+        cache = ParseCache(self.path, touch_batch=1000)
+        cache.put('first', {'n': 1})
+        cache.get('first')
+        self.assertEqual(len(cache.touched), 1)
+        cache.flush()
+        self.assertEqual(cache.touched, {})
+
+
+if __name__ == '__main__':
+    unittest.main()